@@ -0,0 +1,197 @@
+"""Local stand-ins for the OpenAI-compatible and Anthropic HTTP APIs.
+
+Used by loadtest.py so the backend can be driven under load without real
+provider keys. Behaviour is configured through environment variables:
+
+    FAKE_LATENCY_MS         base latency before a response starts (default 300)
+    FAKE_JITTER_MS          uniform jitter added to the latency (default 100)
+    FAKE_ERROR_RATE         fraction of requests answered with HTTP 500 (default 0)
+    FAKE_TOKENS_PER_SECOND  streaming speed for chat deltas (default 50)
+    FAKE_REPLY_WORDS        words per chat reply (default 60)
+
+Run with: uvicorn fake_providers:app --app-dir backend/bench --port 18080
+"""
+import asyncio
+import base64
+import json
+import os
+import random
+import time
+import uuid
+
+from fastapi import FastAPI, File, Form, Request, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+LATENCY_MS = float(os.getenv("FAKE_LATENCY_MS", "300"))
+JITTER_MS = float(os.getenv("FAKE_JITTER_MS", "100"))
+ERROR_RATE = float(os.getenv("FAKE_ERROR_RATE", "0"))
+TOKENS_PER_SECOND = float(os.getenv("FAKE_TOKENS_PER_SECOND", "50"))
+REPLY_WORDS = int(os.getenv("FAKE_REPLY_WORDS", "60"))
+
+WORDS = "the quick brown fox jumps over a lazy dog while we plan your next steps carefully".split()
+# 1x1 transparent PNG
+PNG_BYTES = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+
+app = FastAPI()
+
+
+async def simulate_latency():
+    await asyncio.sleep((LATENCY_MS + random.uniform(0, JITTER_MS)) / 1000)
+
+
+def injected_error():
+    if ERROR_RATE and random.random() < ERROR_RATE:
+        return JSONResponse(
+            status_code=500,
+            content={"error": {"message": "injected failure", "type": "server_error"}},
+        )
+    return None
+
+
+def reply_words():
+    words = [random.choice(WORDS) for _ in range(REPLY_WORDS)]
+    # Sentence breaks every ~12 words so sentence-level TTS pipelining has work to do.
+    return [w + "." if i % 12 == 11 else w for i, w in enumerate(words)]
+
+
+def sse(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data)}\n\n"
+
+
+# ===== OpenAI-compatible =====
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    await simulate_latency()
+    error = injected_error()
+    if error:
+        return error
+
+    words = reply_words()
+    model = body.get("model", "fake")
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    if not body.get("stream"):
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": len(words), "total_tokens": 100 + len(words)},
+        }
+
+    async def events():
+        for i, word in enumerate(words):
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}],
+            }
+            yield sse(chunk)
+            await asyncio.sleep(1 / TOKENS_PER_SECOND)
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/v1/audio/transcriptions")
+async def transcriptions(file: UploadFile = File(...), model: str = Form("whisper-1")):
+    await file.read()
+    await simulate_latency()
+    return injected_error() or {"text": " ".join(random.choice(WORDS) for _ in range(20))}
+
+
+@app.post("/v1/audio/speech")
+async def speech(request: Request):
+    body = await request.json()
+    await simulate_latency()
+    # Roughly 1 KB of "audio" per 10 characters of input.
+    return injected_error() or Response(os.urandom(max(1024, len(body.get("input", "")) * 100)), media_type="audio/mpeg")
+
+
+@app.post("/v1/embeddings")
+async def embeddings(request: Request):
+    body = await request.json()
+    inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    # Embedding calls are much cheaper than completions upstream.
+    await asyncio.sleep(LATENCY_MS / 4000)
+    error = injected_error()
+    if error:
+        return error
+    data = []
+    for i, text in enumerate(inputs):
+        rng = random.Random(text)
+        data.append({"object": "embedding", "index": i, "embedding": [rng.uniform(-1, 1) for _ in range(256)]})
+    return {"object": "list", "data": data, "model": body.get("model", "text-embedding-3-small"),
+            "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+
+
+@app.post("/v1/images/generations")
+async def images(request: Request):
+    body = await request.json()
+    await simulate_latency()
+    error = injected_error()
+    if error:
+        return error
+    if body.get("response_format") == "b64_json":
+        return {"created": int(time.time()), "data": [{"b64_json": base64.b64encode(PNG_BYTES).decode()}]}
+    return {"created": int(time.time()), "data": [{"url": "https://example.invalid/image.png"}]}
+
+
+# ===== Anthropic =====
+
+@app.post("/v1/messages")
+async def messages(request: Request):
+    body = await request.json()
+    await simulate_latency()
+    error = injected_error()
+    if error:
+        return error
+
+    words = reply_words()
+    message_id = f"msg_{uuid.uuid4().hex}"
+    model = body.get("model", "fake")
+    if not body.get("stream"):
+        return {
+            "id": message_id,
+            "type": "message",
+            "role": "assistant",
+            "model": model,
+            "content": [{"type": "text", "text": " ".join(words)}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": {"input_tokens": 100, "output_tokens": len(words)},
+        }
+
+    async def events():
+        yield sse({"type": "message_start", "message": {
+            "id": message_id, "type": "message", "role": "assistant", "model": model, "content": [],
+            "stop_reason": None, "stop_sequence": None, "usage": {"input_tokens": 100, "output_tokens": 0},
+        }}, "message_start")
+        yield sse({"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}, "content_block_start")
+        for i, word in enumerate(words):
+            delta = {"type": "text_delta", "text": word if i == 0 else " " + word}
+            yield sse({"type": "content_block_delta", "index": 0, "delta": delta}, "content_block_delta")
+            await asyncio.sleep(1 / TOKENS_PER_SECOND)
+        yield sse({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        yield sse({"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                   "usage": {"output_tokens": len(words)}}, "message_delta")
+        yield sse({"type": "message_stop"}, "message_stop")
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+# ===== Research target =====
+
+@app.get("/page/{page_id}")
+async def page(page_id: str):
+    await simulate_latency()
+    paragraphs = "".join(f"<p>{' '.join(random.choice(WORDS) for _ in range(40))}</p>" for _ in range(200))
+    html = f"<html><head><title>Fake page {page_id}</title></head><body>{paragraphs}</body></html>"
+    return Response(html, media_type="text/html", headers={"ETag": f'"{page_id}"'})
@@ -0,0 +1,424 @@
+"""Load and latency benchmark for backend/server.py.
+
+Starts two fake provider servers (OpenAI-compatible and Anthropic, see
+fake_providers.py) and the backend itself against a local mongod, then drives
+the chat, research, document and voice endpoints at fixed concurrency levels.
+For every (scenario, concurrency) pair it reports throughput, p50/p95/p99
+latency, time to first byte for streaming endpoints, and event-loop lag
+(latency of /api/health probes sent while the load runs).
+
+Results are written as JSON; pass a previous result file with --compare to
+flag regressions (exit status 1).
+
+    python backend/bench/loadtest.py --concurrency 1,8,32 --duration 15 \\
+        --save backend/bench/results/baseline.json
+    python backend/bench/loadtest.py --compare backend/bench/results/baseline.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import wave
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import httpx
+from jose import jwt
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCH_DIR)
+
+SCENARIOS = ["chat", "chat_anthropic", "chat_stream", "research", "document", "transcribe", "speak", "voice_session"]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+# ===== Fixtures =====
+
+def make_png(width=1600, height=1200):
+    from PIL import Image
+    image = Image.frombytes("RGB", (width, height), os.urandom(width * height * 3))
+    out = io.BytesIO()
+    image.save(out, "PNG")
+    return out.getvalue()
+
+
+def make_wav(seconds=5, rate=16000):
+    out = io.BytesIO()
+    with wave.open(out, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(os.urandom(seconds * rate * 2))
+    return out.getvalue()
+
+
+SPEAK_TEXT = (
+    "Good morning! Here is your plan for today. First, review the market report. "
+    "Then call the agent about the property on Main Street. Finally, take a short walk."
+)
+
+
+# ===== Scenarios =====
+# Each scenario performs one request and returns time-to-first-byte (or None).
+# Raising marks the request as failed.
+
+class Worker:
+    def __init__(self, client, token, fixtures, fake_url):
+        self.client = client
+        self.token = token
+        self.headers = {"Authorization": f"Bearer {token}"}
+        self.fixtures = fixtures
+        self.fake_url = fake_url
+        self.conversation_id = None
+        self.turns = 0
+
+    def next_conversation(self):
+        # Keep threads a realistic length: a new conversation every 10 turns.
+        self.turns += 1
+        if self.turns % 10 == 0:
+            self.conversation_id = None
+        return self.conversation_id
+
+    async def chat(self, provider=None):
+        payload = {"message": f"Give me three ideas for today ({random.random()})", "conversation_id": self.next_conversation()}
+        if provider:
+            payload["preferred_provider"] = provider
+        resp = await self.client.post("/api/chat", json=payload, headers=self.headers)
+        resp.raise_for_status()
+        self.conversation_id = resp.json()["conversation_id"]
+
+    async def chat_anthropic(self):
+        await self.chat("anthropic")
+
+    async def chat_stream(self):
+        payload = {"message": f"Tell me a short story ({random.random()})", "conversation_id": self.next_conversation()}
+        started = time.perf_counter()
+        ttfb = None
+        async with self.client.stream("POST", "/api/chat/stream", json=payload, headers=self.headers) as resp:
+            resp.raise_for_status()
+            async for line in resp.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                event = json.loads(line[6:])
+                if event["type"] == "delta" and ttfb is None:
+                    ttfb = time.perf_counter() - started
+                elif event["type"] == "start":
+                    self.conversation_id = event["conversation_id"]
+                elif event["type"] == "error":
+                    raise RuntimeError(event["detail"])
+        return ttfb
+
+    async def research(self):
+        url = f"{self.fake_url}/page/{random.randint(0, 1000)}"
+        resp = await self.client.post("/api/research", json={"query": url, "source": "web"})
+        resp.raise_for_status()
+
+    async def document(self):
+        files = {"file": ("scan.png", self.fixtures["png"], "image/png")}
+        data = {"prompt": f"Summarize this document ({random.random()})"}
+        resp = await self.client.post("/api/document/analyze/upload", files=files, data=data, headers=self.headers)
+        resp.raise_for_status()
+
+    async def transcribe(self):
+        files = {"audio": ("memo.wav", self.fixtures["wav"], "audio/wav")}
+        resp = await self.client.post("/api/voice/transcribe", files=files, headers=self.headers)
+        resp.raise_for_status()
+
+    async def speak(self):
+        started = time.perf_counter()
+        ttfb = None
+        data = {"text": f"{SPEAK_TEXT} ({random.randint(0, 10 ** 6)})"}
+        async with self.client.stream("POST", "/api/voice/speak/stream", data=data, headers=self.headers) as resp:
+            resp.raise_for_status()
+            async for _ in resp.aiter_bytes():
+                if ttfb is None:
+                    ttfb = time.perf_counter() - started
+        return ttfb
+
+    async def voice_session(self):
+        return await asyncio.to_thread(self.voice_turn)
+
+    def voice_turn(self):
+        """One recorded turn over /api/voice/session: WAV up, then {"type": "end"}.
+           TTFB is the first synthesized `audio` frame. Blocking; runs in a thread."""
+        import websocket
+        url = f"{str(self.client.base_url).replace('http', 'ws', 1).rstrip('/')}/api/voice/session?token={self.token}"
+        started = time.perf_counter()
+        ttfb = None
+        ws = websocket.create_connection(url, timeout=120)
+        try:
+            json.loads(ws.recv())  # ready
+            ws.send(json.dumps({"type": "start", "conversation_id": self.next_conversation()}))
+            ws.send_binary(self.fixtures["wav"])
+            ws.send(json.dumps({"type": "end", "filename": "memo.wav"}))
+            while True:
+                frame = ws.recv()
+                if isinstance(frame, bytes):
+                    continue
+                event = json.loads(frame)
+                if event["type"] == "audio" and ttfb is None:
+                    ttfb = time.perf_counter() - started
+                elif event["type"] == "error":
+                    raise RuntimeError(event["detail"])
+                elif event["type"] == "done":
+                    self.conversation_id = event["conversation_id"]
+                    return ttfb
+        finally:
+            ws.close()
+
+
+# ===== Runner =====
+
+async def probe_loop_lag(client, stop, samples, interval=0.1):
+    """/api/health does no I/O, so its latency under load approximates event-loop lag."""
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            await client.get("/api/health")
+            samples.append(time.perf_counter() - started)
+        except httpx.HTTPError:
+            pass
+        await asyncio.sleep(interval)
+
+
+async def run_level(server_url, scenario, concurrency, duration, token, fixtures, fake_url):
+    limits = httpx.Limits(max_connections=concurrency + 2, max_keepalive_connections=concurrency + 2)
+    async with httpx.AsyncClient(base_url=server_url, timeout=120, limits=limits) as client:
+        latencies, ttfbs, errors = [], [], []
+        lag = []
+        stop = asyncio.Event()
+        deadline = time.perf_counter() + duration
+
+        async def worker_loop():
+            worker = Worker(client, token, fixtures, fake_url)
+            action = getattr(worker, scenario)
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    ttfb = await action()
+                    latencies.append(time.perf_counter() - started)
+                    if ttfb is not None:
+                        ttfbs.append(ttfb)
+                except Exception as e:
+                    errors.append(type(e).__name__)
+
+        async with httpx.AsyncClient(base_url=server_url, timeout=30) as probe_client:
+            prober = asyncio.create_task(probe_loop_lag(probe_client, stop, lag))
+            started = time.perf_counter()
+            await asyncio.gather(*(worker_loop() for _ in range(concurrency)))
+            elapsed = time.perf_counter() - started
+            stop.set()
+            await prober
+
+    total = len(latencies) + len(errors)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": len(errors),
+        "error_rate": round(len(errors) / total, 4) if total else 0.0,
+        "error_types": sorted(set(errors)),
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": ms(percentile(latencies, 0.50)),
+        "p95_ms": ms(percentile(latencies, 0.95)),
+        "p99_ms": ms(percentile(latencies, 0.99)),
+        "ttfb_p50_ms": ms(percentile(ttfbs, 0.50)),
+        "ttfb_p95_ms": ms(percentile(ttfbs, 0.95)),
+        "loop_lag_p50_ms": ms(percentile(lag, 0.50)),
+        "loop_lag_p99_ms": ms(percentile(lag, 0.99)),
+    }
+
+
+def start_process(args, env, name):
+    print(f"starting {name}: {' '.join(args)}")
+    return subprocess.Popen(args, env=env, stdout=subprocess.DEVNULL if name != "backend" else None)
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_stack(opts):
+    """Start the fake providers and the backend; returns (processes, server_url, fake_url)."""
+    processes = []
+    fakes = {"openai": (opts.openai_port, opts.openai_latency_ms), "anthropic": (opts.anthropic_port, opts.anthropic_latency_ms)}
+    for name, (port, latency) in fakes.items():
+        env = dict(os.environ,
+                   FAKE_LATENCY_MS=str(latency),
+                   FAKE_JITTER_MS=str(opts.jitter_ms),
+                   FAKE_ERROR_RATE=str(opts.error_rate),
+                   FAKE_TOKENS_PER_SECOND=str(opts.tokens_per_second))
+        processes.append(start_process(
+            [sys.executable, "-m", "uvicorn", "fake_providers:app", "--app-dir", BENCH_DIR,
+             "--port", str(port), "--log-level", "warning"], env, f"fake {name}"))
+
+    openai_url = f"http://127.0.0.1:{opts.openai_port}"
+    anthropic_url = f"http://127.0.0.1:{opts.anthropic_port}"
+    server_url = f"http://127.0.0.1:{opts.server_port}"
+    env = dict(os.environ,
+               MONGO_URL=opts.mongo_url,
+               MONGO_DB_NAME=opts.mongo_db,
+               SECRET_KEY=opts.secret_key,
+               OPENAI_API_KEY="sk-bench",
+               OPENAI_BASE_URL=f"{openai_url}/v1",
+               ANTHROPIC_API_KEY="sk-ant-bench",
+               ANTHROPIC_BASE_URL=anthropic_url,
+               EMERGENT_LLM_KEY="", PERPLEXITY_API_KEY="", TAVILY_API_KEY="",
+               IBM_WATSONX_API_KEY="", AIMLAPI_API_KEY="", GROQ_API_KEY="", MISTRAL_API_KEY="",
+               # Every simulated client is the same user; keep admission in the path but out of the way.
+               ADMISSION_USER_RPM="1000000", ADMISSION_USER_TPM="0",
+               ADMISSION_PROVIDER_RPM="1000000", ADMISSION_PROVIDER_TPM="0",
+               # The research scenario scrapes pages served by the local fake provider.
+               RESEARCH_ALLOW_PRIVATE="true")
+    processes.append(start_process(
+        [sys.executable, "-m", "uvicorn", "server:app", "--app-dir", BACKEND_DIR,
+         "--port", str(opts.server_port), "--workers", str(opts.workers), "--log-level", "warning"], env, "backend"))
+
+    wait_for(f"{openai_url}/docs")
+    wait_for(f"{anthropic_url}/docs")
+    wait_for(f"{server_url}/api/health")
+    return processes, server_url, openai_url
+
+
+def compare(current, baseline, tolerance):
+    """Regressions of `current` against `baseline` beyond `tolerance` (fractional)."""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        base = previous.get((result["scenario"], result["concurrency"]))
+        if not base:
+            continue
+        label = f"{result['scenario']}@{result['concurrency']}"
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "ttfb_p95_ms", "loop_lag_p99_ms"):
+            if base.get(metric) and result.get(metric) and result[metric] > base[metric] * (1 + tolerance):
+                regressions.append(f"{label}: {metric} {base[metric]} -> {result[metric]}")
+        if base["throughput_rps"] and result["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{label}: throughput_rps {base['throughput_rps']} -> {result['throughput_rps']}")
+        if result["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(f"{label}: error_rate {base['error_rate']} -> {result['error_rate']}")
+    return regressions
+
+
+def print_table(results):
+    columns = ["scenario", "concurrency", "requests", "errors", "throughput_rps", "p50_ms", "p95_ms", "p99_ms",
+               "ttfb_p50_ms", "loop_lag_p99_ms"]
+    print(" ".join(f"{c:>15}" for c in columns))
+    for result in results:
+        print(" ".join(f"{str(result[c]):>15}" for c in columns))
+
+
+async def run(opts):
+    scenarios = [s.strip() for s in opts.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    levels = [int(c) for c in opts.concurrency.split(",")]
+    token = jwt.encode({"sub": "bench-user", "exp": int(time.time()) + 24 * 3600}, opts.secret_key, algorithm="HS256")
+    fixtures = {"png": make_png(), "wav": make_wav()}
+    # voice_session drives a blocking WebSocket client per worker thread.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max(levels) + 4))
+
+    processes = []
+    server_url, fake_url = opts.server_url, f"http://127.0.0.1:{opts.openai_port}"
+    try:
+        if not server_url:
+            processes, server_url, fake_url = start_stack(opts)
+        results = []
+        for scenario in scenarios:
+            for concurrency in levels:
+                result = await run_level(server_url, scenario, concurrency, opts.duration, token, fixtures, fake_url)
+                results.append(result)
+                print(f"{scenario}@{concurrency}: {result['throughput_rps']} req/s, p95 {result['p95_ms']} ms, "
+                      f"errors {result['errors']}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+
+    report = {
+        "meta": {
+            "at": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "host": platform.node(),
+            "duration_s": opts.duration,
+            "workers": opts.workers,
+            "openai_latency_ms": opts.openai_latency_ms,
+            "anthropic_latency_ms": opts.anthropic_latency_ms,
+            "jitter_ms": opts.jitter_ms,
+            "error_rate": opts.error_rate,
+            "tokens_per_second": opts.tokens_per_second,
+        },
+        "results": results,
+    }
+    print()
+    print_table(results)
+
+    if opts.save:
+        os.makedirs(os.path.dirname(os.path.abspath(opts.save)), exist_ok=True)
+        with open(opts.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nsaved {opts.save}")
+
+    if opts.compare:
+        with open(opts.compare) as f:
+            regressions = compare(report, json.load(f), opts.tolerance)
+        if regressions:
+            print("\nREGRESSIONS:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\nno regressions")
+    return 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"comma list of {', '.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma list of concurrency levels")
+    parser.add_argument("--duration", type=float, default=15, help="seconds per (scenario, concurrency)")
+    parser.add_argument("--server-url", help="benchmark an already running backend instead of starting one")
+    parser.add_argument("--server-port", type=int, default=18001)
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes for the backend")
+    parser.add_argument("--mongo-url", default=os.getenv("BENCH_MONGO_URL", "mongodb://127.0.0.1:27017"))
+    parser.add_argument("--mongo-db", default="ai_companion_bench")
+    parser.add_argument("--secret-key", default="bench-secret")
+    parser.add_argument("--openai-port", type=int, default=18080)
+    parser.add_argument("--anthropic-port", type=int, default=18081)
+    parser.add_argument("--openai-latency-ms", type=float, default=300)
+    parser.add_argument("--anthropic-latency-ms", type=float, default=500)
+    parser.add_argument("--jitter-ms", type=float, default=100)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake provider calls that fail")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--save", help="write results JSON here")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="allowed fractional regression")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(run(parse_args())))
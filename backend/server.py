@@ -1,26 +1,82 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Header
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, Header, Query, WebSocket, WebSocketDisconnect
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
+import asyncio
+import time
+import re
+import secrets
+import itertools
+import shutil
+import sys
+import wave
 from dotenv import load_dotenv
 import motor.motor_asyncio
 from bson import ObjectId
+from bson.errors import InvalidId
+from gridfs.errors import NoFile
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 import base64
+import hashlib
+import importlib
 import io
-from openai import OpenAI
-import requests
-from bs4 import BeautifulSoup
+import ipaddress
+from openai import APIConnectionError, AsyncOpenAI
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import httpx
 import json
-from PIL import Image
-import aiofiles
+from html.parser import HTMLParser
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
 
 load_dotenv()
 
-app = FastAPI()
+# ===== Lifespan =====
+# Everything a worker needs is set up before it reports ready: indexes exist, the
+# background workers run, and the Mongo pool and provider connections are opened,
+# so the first request pays no TCP/TLS or import cost. Warm-up is best effort and
+# bounded by STARTUP_WARMUP_TIMEOUT. On shutdown (after uvicorn has finished the
+# in-flight requests) the background loops are stopped, pending background work
+# such as partial replies and memory writes gets SHUTDOWN_DRAIN_TIMEOUT to finish,
+# and only then are the pools closed.
+
+STARTUP_WARMUP_TIMEOUT = float(os.getenv("STARTUP_WARMUP_TIMEOUT", "5"))
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "10"))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    start_event_loop_monitor()
+    await asyncio.gather(ensure_conversation_indexes(), ensure_image_job_indexes(), ensure_settings_indexes())
+    run_in_background(migrate_legacy_conversations())
+    start_image_workers()
+    start_settings_sync()
+    try:
+        await asyncio.wait_for(asyncio.gather(
+            warm_database(),
+            warm_provider_connections(),
+            asyncio.to_thread(importlib.import_module, "numpy"),  # memory recall and the response cache
+        ), STARTUP_WARMUP_TIMEOUT)
+    except asyncio.TimeoutError:
+        print("Warm-up did not finish in time; continuing")
+
+    yield
+
+    stop_settings_sync()
+    await stop_image_workers()
+    stop_event_loop_monitor()
+    await drain_background_tasks()
+    await close_http_client()
+    client.close()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS
 app.add_middleware(
@@ -31,37 +87,250 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# MongoDB
-client = motor.motor_asyncio.AsyncIOMotorClient(os.getenv("MONGO_URL"))
-db = client.ai_companion
+# ===== Metrics =====
+# Prometheus metrics served from /metrics. Request latency is recorded per route
+# template by an ASGI middleware (for streaming responses this covers the whole
+# stream). Chat requests additionally record time per phase, provider calls
+# record latency and in-flight counts, LLM calls count prompt/completion tokens,
+# and a monitor task measures how long the event loop is blocked. With several
+# worker processes, set PROMETHEUS_MULTIPROC_DIR so /metrics aggregates them.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 120)
+METRICS_USER_LABEL = os.getenv("METRICS_USER_LABEL", "true").lower() == "true"
+LOOP_MONITOR_INTERVAL = float(os.getenv("LOOP_MONITOR_INTERVAL", "0.1"))
+LOOP_BLOCK_THRESHOLD = float(os.getenv("LOOP_BLOCK_THRESHOLD", "0.05"))
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route", ["method", "route", "status"], buckets=LATENCY_BUCKETS
+)
+PHASE_LATENCY = Histogram(
+    "request_phase_duration_seconds", "Time spent per request phase (auth, settings, history, provider, db_write)",
+    ["phase"], buckets=LATENCY_BUCKETS
+)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds", "Provider call latency", ["provider", "operation", "outcome"], buckets=LATENCY_BUCKETS
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "upstream_requests_in_flight", "Provider calls currently open", ["provider", "operation"], multiprocess_mode="livesum"
+)
+LLM_TOKENS = Counter("llm_tokens_total", "LLM tokens by provider, model and user", ["provider", "model", "user", "kind"])
+LOOP_LAG = Histogram(
+    "event_loop_lag_seconds", "Event loop scheduling delay", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+)
+LOOP_BLOCKED = Counter("event_loop_blocked_seconds_total", "Event loop time blocked beyond LOOP_BLOCK_THRESHOLD")
+RESPONSE_CACHE_LOOKUPS = Counter("response_cache_lookups_total", "Response cache lookups by endpoint and result", ["endpoint", "result"])
+
+_current_user: ContextVar[str] = ContextVar("current_user", default="")
+
+class MetricsMiddleware:
+    """Pure ASGI middleware recording latency per route template and status."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        started = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            REQUEST_LATENCY.labels(scope["method"], route.path if route else "unmatched", str(status)).observe(
+                time.perf_counter() - started
+            )
+
+app.add_middleware(MetricsMiddleware)
+
+@contextmanager
+def phase(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        PHASE_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+@contextmanager
+def upstream_call(provider: str, operation: str):
+    in_flight = UPSTREAM_IN_FLIGHT.labels(provider, operation)
+    in_flight.inc()
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    except (asyncio.CancelledError, GeneratorExit):
+        outcome = "cancelled"
+        raise
+    finally:
+        in_flight.dec()
+        UPSTREAM_LATENCY.labels(provider, operation, outcome).observe(time.perf_counter() - started)
+
+def record_tokens(provider: str, model: str, prompt_tokens: int, completion_tokens: int):
+    user = _current_user.get() if METRICS_USER_LABEL else ""
+    LLM_TOKENS.labels(provider, model, user, "prompt").inc(prompt_tokens or 0)
+    LLM_TOKENS.labels(provider, model, user, "completion").inc(completion_tokens or 0)
+    ticket = _admission_ticket.get()
+    if ticket and completion_tokens:
+        run_in_background(charge_tokens(ticket, completion_tokens))
+
+async def monitor_event_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(LOOP_MONITOR_INTERVAL)
+        lag = max(0.0, loop.time() - started - LOOP_MONITOR_INTERVAL)
+        LOOP_LAG.observe(lag)
+        if lag > LOOP_BLOCK_THRESHOLD:
+            LOOP_BLOCKED.inc(lag)
+
+# MongoDB. The client connects lazily; warm_database opens the pool at startup.
+MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", "100"))
+MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", "10"))
+client = motor.motor_asyncio.AsyncIOMotorClient(
+    os.getenv("MONGO_URL"),
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    serverSelectionTimeoutMS=int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", "10000")),
+)
+db = client[os.getenv("MONGO_DB_NAME", "ai_companion")]
+
+async def warm_database():
+    try:
+        await db.command("ping")
+    except Exception as e:
+        print(f"Database warm-up error: {e}")
 
 # API Keys Storage (will be in DB per user)
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key")
 ALGORITHM = "HS256"
 
-def get_current_user(authorization: str = Header(...)):
-    credentials_exception = HTTPException(
-        status_code=401,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
+class TTLCache:
+    """Bounded LRU cache whose entries expire after `ttl` seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key, value, ttl: Optional[float] = None):
+        self._data[key] = (value, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+# Verified JWTs (token -> username), never cached past the token's own `exp`.
+token_cache = TTLCache(maxsize=int(os.getenv("TOKEN_CACHE_SIZE", "10000")), ttl=float(os.getenv("TOKEN_CACHE_TTL", "300")))
+# Per-user API key settings. Writes invalidate locally; other workers pick up the
+# change through the settings version poll (see sync_settings_cache) within
+# SETTINGS_SYNC_INTERVAL seconds, with the TTL as a backstop.
+settings_cache = TTLCache(maxsize=int(os.getenv("SETTINGS_CACHE_SIZE", "10000")), ttl=float(os.getenv("SETTINGS_CACHE_TTL", "300")))
+SETTINGS_SYNC_INTERVAL = float(os.getenv("SETTINGS_SYNC_INTERVAL", "5"))
+SETTINGS_SYNC_OVERLAP = float(os.getenv("SETTINGS_SYNC_OVERLAP", "30"))  # max delay between taking a version and writing it
+
+CREDENTIALS_EXCEPTION = HTTPException(
+    status_code=401,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"},
+)
+
+def verify_token(token: str) -> str:
+    """Return the username for a bearer token, using the verified-token cache."""
+    username = token_cache.get(token)
+    if username is not None:
+        return username
+
     try:
-        scheme, token = authorization.split()
-        if scheme.lower() != "bearer":
-            raise credentials_exception
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
-            raise credentials_exception
+            raise CREDENTIALS_EXCEPTION
     except JWTError:
-        raise credentials_exception
+        raise CREDENTIALS_EXCEPTION
+
+    ttl = token_cache.ttl
+    if payload.get("exp"):
+        ttl = min(ttl, payload["exp"] - time.time())
+    if ttl > 0:
+        token_cache.set(token, username, ttl)
+    return username
+
+async def get_current_user(authorization: str = Header(...)):
+    try:
+        scheme, token = authorization.split()
+    except ValueError:
+        raise CREDENTIALS_EXCEPTION
+    if scheme.lower() != "bearer":
+        raise CREDENTIALS_EXCEPTION
+    with phase("auth"):
+        username = verify_token(token)
+    _current_user.set(username)
     return username
 
 async def get_user_api_keys(user_id: str):
-    user_settings = await db.settings.find_one({"user_id": user_id})
-    if user_settings and "api_keys" in user_settings:
-        return user_settings["api_keys"]
-    return {}
+    with phase("settings"):
+        api_keys = settings_cache.get(user_id)
+        if api_keys is None:
+            user_settings = await db.settings.find_one({"user_id": user_id}, {"api_keys": 1})
+            api_keys = (user_settings or {}).get("api_keys") or {}
+            settings_cache.set(user_id, api_keys)
+    return api_keys
+
+async def sync_settings_cache():
+    """Drop cached settings of users whose settings were written by any worker.
+       Each write bumps a global counter and stamps the settings document with it,
+       so one indexed query per interval finds everything that changed. Concurrent
+       writes can land out of version order, so each poll re-reads from the version
+       seen SETTINGS_SYNC_OVERLAP seconds ago and skips (user, version) pairs it has
+       already handled."""
+    last_version = 0
+    meta = await db.meta.find_one({"key": "settings_version"})
+    if meta:
+        last_version = meta.get("value", 0)
+    checkpoints = deque([(time.monotonic(), last_version)])  # (polled at, highest version seen)
+    seen = set()
+    while True:
+        await asyncio.sleep(SETTINGS_SYNC_INTERVAL)
+        try:
+            now = time.monotonic()
+            while len(checkpoints) > 1 and checkpoints[1][0] <= now - SETTINGS_SYNC_OVERLAP:
+                checkpoints.popleft()
+            floor = checkpoints[0][1]
+            async for doc in db.settings.find({"version": {"$gt": floor}}, {"user_id": 1, "version": 1}):
+                if (doc["user_id"], doc["version"]) not in seen:
+                    seen.add((doc["user_id"], doc["version"]))
+                    settings_cache.pop(doc["user_id"])
+                last_version = max(last_version, doc["version"])
+            checkpoints.append((now, last_version))
+            seen = {entry for entry in seen if entry[1] > floor}
+        except Exception as e:
+            print(f"Settings sync error: {e}")
 
 API_KEYS = {
     "openai": os.getenv("OPENAI_API_KEY", ""),
@@ -83,10 +352,25 @@ class ChatMessage(BaseModel):
     conversation_id: Optional[str] = None
     use_fallback: bool = False
     preferred_provider: Optional[str] = None  # openai, anthropic, emergent_llm
+    hedge: Optional[bool] = None  # defaults to ROUTER_HEDGE
+
+class BatchJob(BaseModel):
+    id: Optional[str] = None  # echoed back; defaults to the job's index
+    prompt: str
+    system_prompt: Optional[str] = None
+    preferred_provider: Optional[str] = None
+    model: Optional[str] = None  # only used when preferred_provider serves the job
+    use_fallback: bool = False
+    max_tokens: Optional[int] = None
+    temperature: float = 0.7
+
+class BatchRequest(BaseModel):
+    jobs: List[BatchJob]
 
 class ImageGenerationRequest(BaseModel):
     prompt: str
     size: str = "1024x1024"
+    quality: str = "hd"
     use_fallback: bool = False
     preferred_provider: Optional[str] = None
 
@@ -96,6 +380,9 @@ class ResearchRequest(BaseModel):
     use_fallback: bool = False
     preferred_provider: Optional[str] = None
 
+class ResearchURLsRequest(BaseModel):
+    urls: List[str]
+
 class APIKeysUpdate(BaseModel):
     openai: Optional[str] = None
     perplexity: Optional[str] = None
@@ -137,43 +424,501 @@ def model_for_provider(provider: str, use_fallback: bool = False):
             return "gpt-4o-mini"
         return "gpt-4o"
 
+# ===== Provider client registry =====
+# SDK clients are long-lived and async. They are cached per (provider, api key,
+# base_url) and all share one HTTP/2 connection pool, so TLS sessions survive
+# across requests instead of being rebuilt for every call.
+
+PROVIDER_BASE_URLS = {
+    "openai": None,
+    "anthropic": None,
+    "ibm_watsonx": "https://us-south.ml.cloud.ibm.com",
+    "aimlapi": "https://api.aimlapi.com",
+    "groq": "https://api.groq.com/openai/v1",
+    "mistral": "https://api.mistral.ai/v1",
+    "emergent_llm": "https://llm.emergentagi.com/v1",
+}
+PROVIDER_ORDER = ["openai", "anthropic", "ibm_watsonx", "aimlapi", "groq", "mistral", "emergent_llm"]
+
+AI_CLIENT_CACHE_SIZE = int(os.getenv("AI_CLIENT_CACHE_SIZE", "256"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "200"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "50"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+_http_client: Optional[httpx.AsyncClient] = None
+_ai_clients: "OrderedDict[tuple, Any]" = OrderedDict()
+
+def get_http_client() -> httpx.AsyncClient:
+    """Shared async HTTP pool used by every provider SDK client."""
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+        )
+    return _http_client
+
+def get_provider_client(provider: str, api_key: str, base_url: Optional[str] = None):
+    """Return a cached async SDK client for (provider, api_key, base_url).
+       Least recently used clients are dropped once AI_CLIENT_CACHE_SIZE is reached;
+       the underlying connection pool is shared, so eviction never closes sockets."""
+    if base_url is None:
+        base_url = PROVIDER_BASE_URLS.get(provider)
+    key = (provider, api_key, base_url)
+    client = _ai_clients.get(key)
+    if client is not None:
+        _ai_clients.move_to_end(key)
+        return client
+
+    if provider == "anthropic":
+        import anthropic
+        client = anthropic.AsyncAnthropic(api_key=api_key, http_client=get_http_client())
+    else:
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=get_http_client())
+
+    _ai_clients[key] = client
+    while len(_ai_clients) > AI_CLIENT_CACHE_SIZE:
+        _ai_clients.popitem(last=False)
+    return client
+
 def get_openai_client(use_fallback: bool = False):
     """Get OpenAI client with primary or fallback key"""
     if use_fallback and API_KEYS["emergent_llm"]:
-        return OpenAI(api_key=API_KEYS["emergent_llm"], base_url="https://llm.emergentagi.com/v1")
-    return OpenAI(api_key=API_KEYS["openai"])
+        return get_provider_client("emergent_llm", API_KEYS["emergent_llm"])
+    return get_provider_client("openai", API_KEYS["openai"])
 
-def get_ai_client(preferred_provider: str = None, use_fallback: bool = False, user_api_keys: Dict[str, str] = None):
-    """Select an AI client for the requested or first-available provider with a configured key.
-       If no suitable provider has a key, raise a 400 with a helpful message."""
+def get_ai_candidates(preferred_provider: str = None, use_fallback: bool = False, user_api_keys: Dict[str, str] = None):
+    """All providers with a configured key as [(client, provider), ...] in routing order:
+       the requested provider, the fallback provider, then PROVIDER_ORDER. Providers whose
+       circuit breaker is open are moved to the back so they are only tried as a last resort."""
+    user_api_keys = user_api_keys or {}
     selection = []
     if preferred_provider:
         selection.append(preferred_provider)
     if use_fallback:
         selection.append("emergent_llm")
-    selection += ["openai", "anthropic", "ibm_watsonx", "aimlapi", "groq", "mistral", "emergent_llm"]
+    selection += PROVIDER_ORDER
 
     seen = set()
     ordered = [p for p in selection if not (p in seen or seen.add(p))]
 
+    candidates = []
     for prov in ordered:
-        if prov == "openai" and (user_api_keys.get("openai") or API_KEYS.get("openai")):
-            return OpenAI(api_key=user_api_keys.get("openai") or API_KEYS["openai"]), "openai"
-        if prov == "anthropic" and (user_api_keys.get("anthropic") or API_KEYS.get("anthropic")):
-            import anthropic
-            return anthropic.Anthropic(api_key=user_api_keys.get("anthropic") or API_KEYS["anthropic"]), "anthropic"
-        if prov == "ibm_watsonx" and (user_api_keys.get("ibm_watsonx") or API_KEYS.get("ibm_watsonx")):
-            return OpenAI(api_key=user_api_keys.get("ibm_watsonx") or API_KEYS["ibm_watsonx"], base_url="https://us-south.ml.cloud.ibm.com"), "ibm_watsonx"
-        if prov == "aimlapi" and (user_api_keys.get("aimlapi") or API_KEYS.get("aimlapi")):
-            return OpenAI(api_key=user_api_keys.get("aimlapi") or API_KEYS["aimlapi"], base_url="https://api.aimlapi.com"), "aimlapi"
-        if prov == "groq" and (user_api_keys.get("groq") or API_KEYS.get("groq")):
-            return OpenAI(api_key=user_api_keys.get("groq") or API_KEYS["groq"], base_url="https://api.groq.com/openai/v1"), "groq"
-        if prov == "mistral" and (user_api_keys.get("mistral") or API_KEYS.get("mistral")):
-            return OpenAI(api_key=user_api_keys.get("mistral") or API_KEYS["mistral"], base_url="https://api.mistral.ai/v1"), "mistral"
-        if prov == "emergent_llm" and (user_api_keys.get("emergent_llm") or API_KEYS.get("emergent_llm")):
-            return OpenAI(api_key=user_api_keys.get("emergent_llm") or API_KEYS["emergent_llm"], base_url="https://llm.emergentagi.com/v1"), "emergent_llm"
-
-    raise HTTPException(status_code=400, detail="No enabled LLM provider found. Add an API key in Settings.")
+        if prov not in PROVIDER_BASE_URLS:
+            continue
+        api_key = user_api_keys.get(prov) or API_KEYS.get(prov)
+        if api_key:
+            candidates.append((get_provider_client(prov, api_key), prov))
+
+    if not candidates:
+        raise HTTPException(status_code=400, detail="No enabled LLM provider found. Add an API key in Settings.")
+    healthy = [c for c in candidates if provider_available(c[1], model_for_provider(c[1], use_fallback), c[0])]
+    return healthy + [c for c in candidates if c not in healthy]
+
+def get_ai_client(preferred_provider: str = None, use_fallback: bool = False, user_api_keys: Dict[str, str] = None):
+    """Select an AI client for the requested or first-available provider with a configured key.
+       If no suitable provider has a key, raise a 400 with a helpful message."""
+    return get_ai_candidates(preferred_provider, use_fallback, user_api_keys)[0]
+
+# ===== Admission control =====
+# Every routed LLM call is admitted against two token buckets per subject, one for
+# requests/min and one for tokens/min: the calling user, and the provider key the
+# call is billed to. Buckets live in db.rate_limits and are refilled and debited in
+# a single atomic update, so the limits hold across worker processes. Prompt tokens
+# are estimated and taken up front; completion tokens are debited once known, which
+# may leave a bucket in debt. A call over its limit waits in a FIFO per bucket for
+# up to ADMISSION_MAX_WAIT instead of failing straight away, and a user may only
+# hold ADMISSION_USER_QUEUE waiting slots. The user is admitted once per request,
+# before routing, and one deadline covers the whole request; only a busy provider
+# key sends the router on to the next candidate. A 429 with Retry-After from upstream
+# blocks the provider key for that long. A limit of 0 disables that dimension.
+
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+ADMISSION_USER_RPM = int(os.getenv("ADMISSION_USER_RPM", "30"))
+ADMISSION_USER_TPM = int(os.getenv("ADMISSION_USER_TPM", "60000"))
+ADMISSION_PROVIDER_RPM = int(os.getenv("ADMISSION_PROVIDER_RPM", "500"))
+ADMISSION_PROVIDER_TPM = int(os.getenv("ADMISSION_PROVIDER_TPM", "200000"))
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT", "10"))
+ADMISSION_USER_QUEUE = int(os.getenv("ADMISSION_USER_QUEUE", "4"))
+ADMISSION_DEFAULT_RETRY_AFTER = float(os.getenv("ADMISSION_DEFAULT_RETRY_AFTER", "1"))
+UNLIMITED = 1e12
+
+class AdmissionRejected(HTTPException):
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(
+            status_code=429,
+            detail="Too many requests. Please try again shortly.",
+            headers={"Retry-After": str(max(1, int(retry_after + 0.999)))},
+        )
+
+_admission_locks: Dict[str, asyncio.Lock] = {}
+_admission_waiting: Dict[str, int] = {}
+_admission_ticket: ContextVar[tuple] = ContextVar("admission_ticket", default=())
+
+def api_key_fingerprint(api_key: str) -> str:
+    return hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+
+def key_fingerprint(client) -> str:
+    return api_key_fingerprint(getattr(client, "api_key", "") or "")
+
+def provider_key_subject(provider: str, client) -> str:
+    return f"key:{provider}:{key_fingerprint(client)}"
+
+async def take_tokens(subject: str, rpm: int, tpm: int, cost: int) -> float:
+    """Refill and debit one bucket atomically. Returns 0 when the call is admitted,
+       otherwise the number of seconds until it could be."""
+    rpm, tpm = rpm or UNLIMITED, tpm or UNLIMITED
+    cost = min(cost, tpm)  # an oversized prompt must still fit an empty bucket
+    now = time.time()
+    elapsed = {"$max": [0, {"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}]}
+
+    def refill(field: str, capacity: float):
+        level = {"$ifNull": [f"${field}", capacity]}
+        return {"$min": [capacity, {"$add": [level, {"$multiply": [elapsed, capacity / 60]}]}]}
+
+    try:
+        bucket = await db.rate_limits.find_one_and_update(
+            {"_id": subject},
+            [
+                {"$set": {"requests": refill("requests", rpm), "tokens": refill("tokens", tpm), "updated_at": now,
+                          "expires_at": datetime.utcnow() + timedelta(hours=1)}},
+                {"$set": {"admitted": {"$and": [
+                    {"$gte": ["$requests", 1]},
+                    {"$gte": ["$tokens", cost]},
+                    {"$lte": [{"$ifNull": ["$blocked_until", 0]}, now]},
+                ]}}},
+                {"$set": {
+                    "requests": {"$cond": ["$admitted", {"$subtract": ["$requests", 1]}, "$requests"]},
+                    "tokens": {"$cond": ["$admitted", {"$subtract": ["$tokens", cost]}, "$tokens"]},
+                }},
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except Exception as e:
+        print(f"Rate limit error: {e}")
+        return 0.0  # fail open: the limiter must not take chat down with it
+    if bucket["admitted"]:
+        return 0.0
+    return max(
+        (1 - bucket["requests"]) * 60 / rpm,
+        (cost - bucket["tokens"]) * 60 / tpm,
+        bucket.get("blocked_until", 0) - now,
+        0.05,
+    )
+
+async def wait_for_bucket(subject: str, rpm: int, tpm: int, cost: int, deadline: float, queue_limit: Optional[int] = None):
+    if not _admission_waiting.get(subject):
+        wait = await take_tokens(subject, rpm, tpm, cost)
+        if not wait:
+            return
+    else:
+        wait = 0.0
+    if queue_limit is not None and _admission_waiting.get(subject, 0) >= queue_limit:
+        raise AdmissionRejected(wait or ADMISSION_DEFAULT_RETRY_AFTER)
+
+    _admission_waiting[subject] = _admission_waiting.get(subject, 0) + 1
+    lock = _admission_locks.setdefault(subject, asyncio.Lock())
+    try:
+        async with lock:  # asyncio.Lock wakes waiters in arrival order
+            while True:
+                if wait:
+                    if time.monotonic() + wait > deadline:
+                        raise AdmissionRejected(wait)
+                    await asyncio.sleep(wait)
+                wait = await take_tokens(subject, rpm, tpm, cost)
+                if not wait:
+                    return
+    finally:
+        _admission_waiting[subject] -= 1
+        if not _admission_waiting[subject]:
+            del _admission_waiting[subject]
+            _admission_locks.pop(subject, None)
+
+async def charge_tokens(subjects, tokens: int):
+    if subjects and tokens:
+        try:
+            await db.rate_limits.update_many({"_id": {"$in": list(subjects)}}, {"$inc": {"tokens": -tokens}})
+        except Exception as e:
+            print(f"Rate limit error: {e}")
+
+async def refund_tokens(subjects, tokens: int):
+    try:
+        await db.rate_limits.update_many({"_id": {"$in": list(subjects)}}, {"$inc": {"requests": 1, "tokens": tokens}})
+    except Exception as e:
+        print(f"Rate limit error: {e}")
+
+def admission_deadline() -> float:
+    return time.monotonic() + ADMISSION_MAX_WAIT
+
+async def admit_user(tokens: int, deadline: float) -> tuple:
+    """Wait until the current user has capacity for one request of `tokens` prompt
+       tokens. Called once per request, before routing; returns the charged bucket ids
+       and raises AdmissionRejected if the wait would run past `deadline`."""
+    user = _current_user.get()
+    if not ADMISSION_ENABLED or not user or not (ADMISSION_USER_RPM or ADMISSION_USER_TPM):
+        return ()
+    subject = f"user:{user}"
+    await wait_for_bucket(subject, ADMISSION_USER_RPM, ADMISSION_USER_TPM, tokens, deadline, ADMISSION_USER_QUEUE)
+    return (subject,)
+
+async def admit_provider(provider: str, client, tokens: int, deadline: float) -> tuple:
+    """Same for the provider key one routing attempt is billed to. A rejection here
+       only rules out this candidate; the router moves on to the next one."""
+    if not ADMISSION_ENABLED or not (ADMISSION_PROVIDER_RPM or ADMISSION_PROVIDER_TPM):
+        return ()
+    subject = provider_key_subject(provider, client)
+    await wait_for_bucket(subject, ADMISSION_PROVIDER_RPM, ADMISSION_PROVIDER_TPM, tokens, deadline)
+    return (subject,)
+
+def refund_if_unused(ticket: tuple, errors: List[Exception], tokens: int):
+    """Give the user's request back when every candidate was turned away before going upstream."""
+    if ticket and errors and all(isinstance(e, AdmissionRejected) for e in errors):
+        run_in_background(refund_tokens(ticket, tokens))
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """Back-off requested by an upstream 429, from Retry-After(-Ms) when present."""
+    if getattr(error, "status_code", None) != 429:
+        return None
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if value:
+            try:
+                return float(value)
+            except ValueError:
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return ADMISSION_DEFAULT_RETRY_AFTER
+
+async def note_upstream_error(provider: str, client, error: Exception):
+    seconds = retry_after_seconds(error)
+    if seconds is None or not ADMISSION_ENABLED:
+        return
+    try:
+        await db.rate_limits.update_one(
+            {"_id": provider_key_subject(provider, client)},
+            {"$max": {"blocked_until": time.time() + seconds}},
+            upsert=True,
+        )
+    except Exception as e:
+        print(f"Rate limit error: {e}")
+
+# ===== Provider routing =====
+# Every routed call records its latency and outcome per (provider, model, key), so
+# one user's revoked personal key cannot take a provider away from everybody else.
+# Only availability failures (timeouts, connection errors, 5xx and 429) count
+# against a provider; other 4xx errors and client-side bugs fail the call without
+# touching its health. A provider that keeps failing trips its circuit breaker and
+# is skipped until a cool-down passes, after which a single probe request decides
+# whether it closes again. Health is kept for the PROVIDER_HEALTH_SIZE most recently
+# used keys; /api/router/status lists the server's own keys and only aggregate
+# counts for users' personal keys. route_call fails over to the next candidate within the same request and
+# can optionally hedge: if the primary has not answered after its p95 latency, a
+# second provider is fired and whichever succeeds first wins.
+
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_ERROR_RATE = float(os.getenv("CIRCUIT_ERROR_RATE", "0.5"))
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "30"))
+HEALTH_WINDOW = int(os.getenv("HEALTH_WINDOW", "100"))
+PROVIDER_HEALTH_SIZE = int(os.getenv("PROVIDER_HEALTH_SIZE", "1024"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "8"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.5"))
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "false").lower() == "true"
+
+class ProviderHealth:
+    """Rolling latency/error window and circuit breaker for one provider/model/key."""
+
+    def __init__(self, provider: str, model: str, key: str):
+        self.provider = provider
+        self.model = model
+        self.key = key
+        self.latencies = deque(maxlen=HEALTH_WINDOW)
+        self.outcomes = deque(maxlen=HEALTH_WINDOW)
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def available(self) -> bool:
+        if self.state == "open" and time.monotonic() - self.opened_at >= CIRCUIT_COOLDOWN:
+            self.state = "half_open"
+        if self.state == "half_open":
+            return not self.probe_in_flight
+        return self.state == "closed"
+
+    def start(self):
+        if self.state == "half_open":
+            self.probe_in_flight = True
+
+    def record_success(self, latency: float):
+        self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.probe_in_flight = False
+
+    def record_failure(self):
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        self.probe_in_flight = False
+        if self.state == "half_open" or self.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD or (
+            len(self.outcomes) >= 10 and self.error_rate() >= CIRCUIT_ERROR_RATE
+        ):
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def record_cancelled(self):
+        self.probe_in_flight = False
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        self.available()
+        return {
+            "provider": self.provider,
+            "model": self.model,
+            "key": self.key[:8],
+            "state": self.state,
+            "samples": len(self.outcomes),
+            "error_rate": round(self.error_rate(), 3),
+            "consecutive_failures": self.consecutive_failures,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+        }
+
+_provider_health: "OrderedDict[tuple, ProviderHealth]" = OrderedDict()
+routing_decisions = deque(maxlen=50)
+
+def provider_health_for(provider: str, model: str, client) -> ProviderHealth:
+    key = (provider, model, key_fingerprint(client))
+    health = _provider_health.get(key)
+    if health is not None:
+        _provider_health.move_to_end(key)
+        return health
+    health = _provider_health[key] = ProviderHealth(*key)
+    while len(_provider_health) > PROVIDER_HEALTH_SIZE:
+        _provider_health.popitem(last=False)
+    return health
+
+def provider_available(provider: str, model: str, client) -> bool:
+    """Breaker check that does not start tracking a key that was never called."""
+    health = _provider_health.get((provider, model, key_fingerprint(client)))
+    return health is None or health.available()
+
+def is_availability_error(error: Exception) -> bool:
+    """True for failures that say the provider is unavailable rather than that this
+       particular request (or key) is bad."""
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status == 429 or status >= 500
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError, ConnectionError, httpx.TransportError, APIConnectionError)):
+        return True
+    anthropic = sys.modules.get("anthropic")
+    return anthropic is not None and isinstance(error, anthropic.APIConnectionError)
+
+def record_outcome(health: ProviderHealth, error: Exception):
+    if is_availability_error(error):
+        health.record_failure()
+    else:
+        health.record_cancelled()  # releases a half-open probe without a verdict
+
+def hedge_delay(health: ProviderHealth) -> float:
+    p95 = health.percentile(0.95)
+    return max(HEDGE_MIN_DELAY, p95) if p95 is not None else HEDGE_DEFAULT_DELAY
+
+def record_routing_decision(attempts: List[str], served: Optional[str], errors: List[Exception], hedged: bool = False):
+    routing_decisions.append({
+        "at": datetime.now().isoformat(),
+        "primary": attempts[0],
+        "attempts": attempts,
+        "served_by": served,
+        "hedged": hedged,
+        "errors": [type(e).__name__ for e in errors],
+    })
+
+async def timed_call(call, client, provider: str, health: ProviderHealth, tokens: int = 0,
+                     deadline: float = 0.0, user_ticket: tuple = ()):
+    # Runs in its own task, so the ticket is only seen by this call's record_tokens.
+    _admission_ticket.set(user_ticket + await admit_provider(provider, client, tokens, deadline))
+    health.start()
+    started = time.monotonic()
+    try:
+        with upstream_call(provider, "chat"):
+            result = await call(client, provider)
+    except asyncio.CancelledError:
+        health.record_cancelled()
+        raise
+    except Exception as e:
+        record_outcome(health, e)
+        await note_upstream_error(provider, client, e)
+        raise
+    health.record_success(time.monotonic() - started)
+    return result
+
+async def route_call(candidates, call, use_fallback: bool = False, hedge: bool = False, tokens: int = 0):
+    """Run `call(client, provider)` against the candidates with failover (and optional
+       hedging). `tokens` is the prompt size charged on admission; the caller's own
+       rate limit is checked once, up front, and one deadline covers the whole request.
+       Returns (result, client, provider); re-raises the last error if all fail."""
+    deadline = admission_deadline()
+    user_ticket = await admit_user(tokens, deadline)
+    queue = list(candidates)
+    pending = {}
+    attempts = []
+    errors = []
+
+    def launch():
+        client, provider = queue.pop(0)
+        health = provider_health_for(provider, model_for_provider(provider, use_fallback), client)
+        task = asyncio.create_task(timed_call(call, client, provider, health, tokens, deadline, user_ticket))
+        pending[task] = (client, provider, health)
+        attempts.append(provider)
+
+    def record(served: Optional[str]):
+        record_routing_decision(attempts, served, errors, hedged=hedge and len(attempts) > len(errors) + 1)
+
+    launch()
+    try:
+        while pending:
+            timeout = None
+            if hedge and queue and len(pending) == 1:
+                timeout = hedge_delay(next(iter(pending.values()))[2])
+            done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                launch()  # hedge: primary is slower than its p95
+                continue
+            for task in done:
+                client, provider, _ = pending.pop(task)
+                if task.exception() is None:
+                    record(provider)
+                    return task.result(), client, provider
+                errors.append(task.exception())
+                print(f"Provider {provider} error: {task.exception()}")
+            if not pending and queue:
+                launch()  # failover to the next eligible provider
+        record(None)
+        refund_if_unused(user_ticket, errors, tokens)
+        raise errors[-1]
+    finally:
+        for task in pending:
+            task.cancel()
 
 def serialize_doc(doc):
     """Convert MongoDB document to JSON serializable format"""
@@ -182,72 +927,1104 @@ def serialize_doc(doc):
     doc["_id"] = str(doc["_id"])
     return doc
 
+async def warm_provider_connections():
+    """Build the SDK clients for the server-wide keys (importing their SDKs and the
+       lazily loaded resource modules) and open a connection to each provider host so
+       the first real call skips the handshake."""
+    async def touch(provider: str, api_key: str):
+        try:
+            sdk = get_provider_client(provider, api_key)
+            _ = sdk.messages if provider == "anthropic" else (sdk.chat.completions, sdk.embeddings)
+            await get_http_client().head(str(sdk.base_url), timeout=STARTUP_WARMUP_TIMEOUT)
+        except Exception as e:
+            print(f"Warm-up error for {provider}: {e}")
+
+    await asyncio.gather(*(touch(p, API_KEYS[p]) for p in PROVIDER_ORDER if API_KEYS.get(p)))
+
+async def close_http_client():
+    _ai_clients.clear()
+    if _http_client is not None:
+        await _http_client.aclose()
+
 # Routes
+
 @app.get("/api/health")
 async def health_check():
     return {"status": "healthy", "timestamp": datetime.now().isoformat()}
 
+@app.get("/metrics")
+async def metrics():
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+_loop_monitor: Optional[asyncio.Task] = None
+
+def start_event_loop_monitor():
+    global _loop_monitor
+    _loop_monitor = run_in_background(monitor_event_loop())
+
+def stop_event_loop_monitor():
+    if _loop_monitor is not None:
+        _loop_monitor.cancel()
+
+@app.get("/api/router/status")
+async def router_status():
+    """Provider health, circuit breaker state and the most recent routing decisions.
+       Users' personal keys are only counted per provider/model, never listed."""
+    server_keys = {api_key_fingerprint(key) for key in API_KEYS.values() if key}
+    providers = []
+    user_keys: Dict[tuple, Dict[str, Any]] = {}
+    for health in list(_provider_health.values()):
+        if health.key in server_keys:
+            providers.append(health.snapshot())
+            continue
+        summary = user_keys.setdefault((health.provider, health.model),
+                                       {"provider": health.provider, "model": health.model, "keys": 0, "open": 0})
+        summary["keys"] += 1
+        summary["open"] += health.state == "open"
+    return {
+        "order": PROVIDER_ORDER,
+        "hedge_enabled": ROUTER_HEDGE,
+        "providers": providers,
+        "user_keys": list(user_keys.values()),
+        "recent_decisions": list(routing_decisions),
+    }
+
+CHAT_SYSTEM_PROMPT = "You are an advanced AI companion and personal assistant. You excel at:\n\n• Deep reasoning and problem-solving across all domains\n• Creating high-quality content, code, and applications\n• Business strategy, real estate analysis, and market research\n• Personal mentorship and companionship\n• Multi-modal communication (text, voice, analysis)\n• Task automation and workflow optimization\n• Learning from interactions to provide increasingly personalized assistance\n\nYou have access to various tools and APIs. Always provide thoughtful, actionable responses. Be proactive in offering suggestions and anticipating needs. Maintain context across conversations and remember preferences. When appropriate, offer to help with related tasks or provide additional value.\n\nKey capabilities:\n- Code generation and analysis\n- Content creation (blogs, marketing, social media)\n- Research and data analysis\n- Voice interactions and transcription\n- Document processing and analysis\n- Image generation and editing\n- Business automation and task management\n- Real estate market analysis\n- Personal development and mentorship\n\nAlways strive to be the most helpful, intelligent, and reliable AI companion possible."
+
+def split_system_messages(messages: List[Dict[str, Any]]):
+    """Anthropic takes the system prompt as a separate argument, not as a message."""
+    system = "\n\n".join(m["content"] for m in messages if m["role"] == "system")
+    return system, [m for m in messages if m["role"] != "system"]
+
+# Conversations hold metadata only; every message is its own document in
+# db.messages keyed by (conversation_id, seq), so a turn is an O(1) insert.
+# The system prompt is referenced by key instead of being copied into each
+# conversation. Conversations from before this layout (an embedded `messages`
+# array) are converted once at startup; they were stored without an owner, so
+# they are kept but no user can open them.
+SYSTEM_PROMPTS = {"default": CHAT_SYSTEM_PROMPT}
+
+async def ensure_conversation_indexes():
+    await db.messages.create_index([("conversation_id", 1), ("seq", 1)], unique=True)
+    await db.conversations.create_index([("user_id", 1), ("updated_at", -1), ("_id", -1)])
+    await db.messages.create_index([("user_id", 1), ("content", "text")])
+    await db.messages.create_index([("user_id", 1), ("_id", -1)])  # memory backfill
+    await db.memories.create_index([("conversation_id", 1), ("seq", 1)], unique=True)
+    await db.memories.create_index([("user_id", 1), ("model", 1), ("_id", 1)])
+    await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+
+async def migrate_conversation(conversation: Dict[str, Any]):
+    """Move a legacy embedded `messages` array into db.messages. Safe to run concurrently."""
+    turns = [m for m in conversation.get("messages") or [] if m.get("role") != "system"]
+    created_at = conversation.get("updated_at") or datetime.now()
+    docs = [
+        {"conversation_id": conversation["_id"], "seq": i, "role": m["role"], "content": m["content"],
+         "tokens": estimate_tokens(m["content"]), "created_at": created_at}
+        for i, m in enumerate(turns)
+    ]
+    if docs:
+        try:
+            await db.messages.insert_many(docs, ordered=False)
+        except BulkWriteError:
+            pass  # already (partially) migrated by another worker
+    await db.conversations.update_one(
+        {"_id": conversation["_id"], "messages": {"$exists": True}},
+        {"$unset": {"messages": ""}, "$set": {"message_count": len(docs), "system_prompt": "default"}}
+    )
+
+async def migrate_legacy_conversations():
+    try:
+        async for conversation in db.conversations.find({"messages": {"$exists": True}}):
+            await migrate_conversation(conversation)
+    except Exception as e:
+        print(f"Conversation migration error: {e}")
+
+# ===== Context window =====
+# The prompt for a turn is: system prompt (+ rolling summary of older turns)
+# followed by as many recent messages as fit the model's token budget. Token
+# counts are estimated once when a message is stored and cached on the message.
+# When unsummarized history outgrows the budget, older turns are folded into
+# conversation.summary in the background, so the per-turn prompt stays roughly
+# constant no matter how long the thread gets. The history is sized for the
+# primary provider; failover and hedged attempts re-trim it to their own model's
+# budget, and providers whose window cannot hold the system prompt plus the user
+# turn are left out.
+
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "claude-3-opus-20240229": 200000,
+    "meta-llama/llama-3-70b-instruct": 8192,
+    "llama2-70b-4096": 4096,
+    "mistral-large-latest": 32768,
+}
+CHAT_MAX_TOKENS = 2000
+CHAT_CONTEXT_BUDGET = int(os.getenv("CHAT_CONTEXT_BUDGET", "6000"))
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and their AI companion. "
+    "Merge the new messages into the current summary. Keep facts, decisions, open tasks and "
+    "user preferences; drop pleasantries. Reply with the updated summary only."
+)
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token plus per-message overhead)."""
+    return len(text or "") // 4 + 4
+
+def message_tokens(message: Dict[str, Any]) -> int:
+    return message.get("tokens") or estimate_tokens(message["content"])
+
+def context_budget(model: str) -> int:
+    window = MODEL_CONTEXT_WINDOWS.get(model, 8192)
+    return min(CHAT_CONTEXT_BUDGET, window - CHAT_MAX_TOKENS)
+
+def fit_history(history: List[Dict[str, Any]], budget: int) -> List[Dict[str, Any]]:
+    """Most recent messages whose cached token counts fit in `budget`, oldest first."""
+    kept = []
+    used = 0
+    for message in reversed(history):
+        used += message_tokens(message)
+        if used > budget:
+            break
+        kept.append(message)
+    kept.reverse()
+    # Providers expect the turns to open with a user message.
+    while kept and kept[0]["role"] != "user":
+        kept.pop(0)
+    return kept
+
+def fit_messages(messages: List[Dict[str, Any]], model: str) -> Optional[List[Dict[str, Any]]]:
+    """A [system, *history, user] prompt trimmed to `model`'s budget, oldest history
+       first; None if the system prompt and the user turn alone do not fit."""
+    budget = context_budget(model) - message_tokens(messages[0]) - message_tokens(messages[-1])
+    if budget < 0:
+        return None
+    return [messages[0], *fit_history(messages[1:-1], budget), messages[-1]]
+
+def fitting_candidates(candidates, messages: List[Dict[str, Any]], use_fallback: bool = False):
+    """The candidates whose model can take `messages` once its history is trimmed."""
+    fitting = [c for c in candidates if fit_messages(messages, model_for_provider(c[1], use_fallback)) is not None]
+    if not fitting:
+        raise HTTPException(status_code=413, detail="The message is too long for the configured models.")
+    return fitting
+
+async def load_history(conversation_id: ObjectId, start_seq: int = 0) -> List[Dict[str, Any]]:
+    cursor = db.messages.find(
+        {"conversation_id": conversation_id, "seq": {"$gte": start_seq}},
+        {"_id": 0, "seq": 1, "role": 1, "content": 1, "tokens": 1}
+    ).sort("seq", 1)
+    return [m async for m in cursor]
+
+async def load_chat_messages(request: ChatMessage, provider: str, user_id: str,
+                             user_api_keys: Optional[Dict[str, str]] = None):
+    """Build the provider message list for a chat turn. Long-term memories are
+       recalled concurrently with the history load. A conversation that belongs to
+       another user is treated as missing. Returns (conversation, messages, needs_summary)."""
+    conversation = None
+    history = []
+    recall = None
+    if MEMORY_ENABLED:
+        recall = asyncio.create_task(recall_memories(user_id, request.message, user_api_keys))
+
+    try:
+        if request.conversation_id:
+            try:
+                conversation_id = ObjectId(request.conversation_id)
+            except InvalidId:
+                raise HTTPException(status_code=400, detail="Invalid conversation id.")
+            with phase("history"):
+                conversation = await db.conversations.find_one({"_id": conversation_id, "user_id": user_id})
+                if conversation:
+                    history = await load_history(conversation["_id"], conversation.get("summary_seq", 0))
+    except BaseException:
+        if recall is not None:
+            recall.cancel()
+        raise
+
+    conversation_meta = conversation or {}
+    system = SYSTEM_PROMPTS.get(conversation_meta.get("system_prompt", "default"), CHAT_SYSTEM_PROMPT)
+    if conversation_meta.get("summary"):
+        system += f"\n\nSummary of the earlier conversation:\n{conversation_meta['summary']}"
+    if recall is not None:
+        hits = await recalled_memories(recall)
+        # Anything at or after summary_seq is already in (or deliberately trimmed from) the prompt.
+        hits = [h for h in hits if h[1]["conversation_id"] != conversation_meta.get("_id")
+                or h[1]["seq"] < conversation_meta.get("summary_seq", 0)][:MEMORY_TOP_K]
+        if hits:
+            system += format_memories(hits)
+
+    budget = context_budget(model_for_provider(provider, request.use_fallback))
+    budget -= estimate_tokens(system) + estimate_tokens(request.message)
+    recent = fit_history(history, max(budget, 0))
+
+    messages = [{"role": "system", "content": system}]
+    messages.extend({"role": m["role"], "content": m["content"]} for m in recent)
+    messages.append({"role": "user", "content": request.message})
+
+    needs_summary = sum(message_tokens(m) for m in history) > max(budget, 0)
+    return conversation, messages, needs_summary
+
+async def recalled_memories(recall: asyncio.Task) -> List[tuple]:
+    try:
+        with phase("memory"):
+            return await asyncio.wait_for(recall, MEMORY_RECALL_TIMEOUT)
+    except Exception as e:
+        print(f"Memory recall error: {e!r}")
+        return []
+
+# Conversations currently being summarized by this worker.
+_summarizing = set()
+
+async def summarize_conversation(conversation_id: ObjectId, client, provider: str):
+    """Fold turns that no longer fit the verbatim window into conversation.summary.
+       Runs off the request path; keeps roughly half the budget as recent verbatim turns."""
+    if conversation_id in _summarizing:
+        return
+    _summarizing.add(conversation_id)
+    try:
+        conversation = await db.conversations.find_one({"_id": conversation_id}, {"summary": 1, "summary_seq": 1})
+        if not conversation:
+            return
+        start_seq = conversation.get("summary_seq", 0)
+        summary = conversation.get("summary", "")
+        budget = context_budget(model_for_provider(provider, use_fallback=True))
+
+        history = await load_history(conversation_id, start_seq)
+        recent = fit_history(history, budget // 2)
+        fold = history[:len(history) - len(recent)]
+        if not fold:
+            return
+
+        # Fold in chunks that each fit the summarizer's own context budget.
+        chunk, used = [], 0
+        for message in fold + [None]:
+            if message is not None and (not chunk or used + message_tokens(message) <= budget):
+                chunk.append(message)
+                used += message_tokens(message)
+                continue
+            transcript = "\n".join(f"{m['role']}: {m['content']}" for m in chunk)
+            summary = await complete_chat(client, provider, [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew messages:\n{transcript}"},
+            ], use_fallback=True, max_tokens=500, temperature=0.2)
+            if message is not None:
+                chunk, used = [message], message_tokens(message)
+
+        seq_filter = start_seq if start_seq else {"$in": [0, None]}
+        await db.conversations.update_one(
+            {"_id": conversation_id, "summary_seq": seq_filter},
+            {"$set": {"summary": summary, "summary_seq": fold[-1]["seq"] + 1}}
+        )
+    except Exception as e:
+        print(f"Summary error: {e}")
+    finally:
+        _summarizing.discard(conversation_id)
+
+def record_usage(provider: str, response):
+    """Token accounting for an OpenAI-compatible completion response."""
+    usage = getattr(response, "usage", None)
+    if usage is not None:
+        record_tokens(provider, getattr(response, "model", ""), usage.prompt_tokens, usage.completion_tokens)
+
+async def complete_chat(client, provider: str, messages: List[Dict[str, Any]], use_fallback: bool = False,
+                        max_tokens: int = CHAT_MAX_TOKENS, temperature: float = 0.7, model: Optional[str] = None) -> str:
+    if provider == "anthropic":
+        system, chat_messages = split_system_messages(messages)
+        response = await client.messages.create(
+            model=model or model_for_provider(provider),
+            max_tokens=max_tokens,
+            temperature=temperature,
+            system=system,
+            messages=chat_messages
+        )
+        record_tokens(provider, response.model, response.usage.input_tokens, response.usage.output_tokens)
+        return response.content[0].text
+    response = await client.chat.completions.create(
+        model=model or model_for_provider(provider, use_fallback),
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens
+    )
+    record_usage(provider, response)
+    return response.choices[0].message.content
+
+async def stream_chat(client, provider: str, messages: List[Dict[str, Any]], use_fallback: bool = False):
+    """Yield text deltas from the provider as they arrive."""
+    if provider == "anthropic":
+        system, chat_messages = split_system_messages(messages)
+        async with client.messages.stream(
+            model=model_for_provider(provider),
+            max_tokens=CHAT_MAX_TOKENS,
+            temperature=0.7,
+            system=system,
+            messages=chat_messages
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+        return
+    stream = await client.chat.completions.create(
+        model=model_for_provider(provider, use_fallback),
+        messages=messages,
+        temperature=0.7,
+        max_tokens=CHAT_MAX_TOKENS,
+        stream=True
+    )
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+async def route_stream(candidates, messages: List[Dict[str, Any]], use_fallback: bool = False):
+    """Stream (client, provider, delta) tuples, failing over to the next candidate
+       as long as no delta has been sent yet. Streams are never hedged. Each
+       candidate gets `messages` re-trimmed to its model (see fitting_candidates)."""
+    attempts = []
+    errors = []
+    prompt_tokens = sum(message_tokens(m) for m in messages)
+    deadline = admission_deadline()
+    user_ticket = await admit_user(prompt_tokens, deadline)
+    for client, provider in candidates:
+        health = provider_health_for(provider, model_for_provider(provider, use_fallback), client)
+        attempts.append(provider)
+        try:
+            ticket = user_ticket + await admit_provider(provider, client, prompt_tokens, deadline)
+        except AdmissionRejected as e:
+            errors.append(e)
+            continue
+        health.start()
+        started = time.monotonic()
+        produced = False
+        completion_chars = 0
+        try:
+            with upstream_call(provider, "chat_stream"):
+                prompt = fit_messages(messages, model_for_provider(provider, use_fallback))
+                async for delta in stream_chat(client, provider, prompt, use_fallback):
+                    produced = True
+                    completion_chars += len(delta)
+                    yield client, provider, delta
+        except (asyncio.CancelledError, GeneratorExit):
+            health.record_cancelled()
+            raise
+        except Exception as e:
+            record_outcome(health, e)
+            errors.append(e)
+            print(f"Provider {provider} error: {e}")
+            await note_upstream_error(provider, client, e)
+            if produced:
+                record_routing_decision(attempts, None, errors)
+                raise
+            continue
+        health.record_success(time.monotonic() - started)
+        record_routing_decision(attempts, provider, errors)
+        # Streamed responses carry no usage block for every provider; estimate instead.
+        record_tokens(provider, model_for_provider(provider, use_fallback), prompt_tokens, completion_chars // 4)
+        run_in_background(charge_tokens(ticket, completion_chars // 4))
+        return
+    record_routing_decision(attempts, None, errors)
+    refund_if_unused(user_ticket, errors, prompt_tokens)
+    raise errors[-1]
+
+async def save_chat_turn(conversation_id: str, user_id: str, exists: bool, user_message: str, ai_message: str, provider: str, partial: bool = False):
+    """Append the user/assistant pair for one turn to db.messages."""
+    with phase("db_write"):
+        messages = await append_chat_turn(ObjectId(conversation_id), user_id, exists, user_message, ai_message, provider, partial)
+    if MEMORY_ENABLED and not partial:
+        run_in_background(remember_messages(user_id, messages))
+
+async def append_chat_turn(cid: ObjectId, user_id: str, exists: bool, user_message: str, ai_message: str, provider: str, partial: bool):
+    now = datetime.now()
+    snippet = preview_text(ai_message, CONVERSATION_SNIPPET_CHARS)
+
+    conversation = None
+    if exists:
+        conversation = await db.conversations.find_one_and_update(
+            {"_id": cid, "user_id": user_id},
+            {"$inc": {"message_count": 2}, "$set": {"updated_at": now, "provider": provider, "snippet": snippet}},
+            projection={"message_count": 1},
+            return_document=ReturnDocument.AFTER,
+        )
+    if conversation is not None:
+        seq = conversation["message_count"] - 2
+    else:  # new, or deleted since it was loaded
+        await db.conversations.insert_one({
+            "_id": cid,
+            "user_id": user_id,
+            "title": preview_text(user_message, CONVERSATION_TITLE_CHARS),
+            "snippet": snippet,
+            "system_prompt": "default",
+            "message_count": 2,
+            "created_at": now,
+            "updated_at": now,
+            "provider": provider
+        })
+        seq = 0
+
+    assistant = {"conversation_id": cid, "user_id": user_id, "seq": seq + 1, "role": "assistant", "content": ai_message,
+                 "tokens": estimate_tokens(ai_message), "created_at": now}
+    if partial:
+        assistant["partial"] = True
+    messages = [
+        {"conversation_id": cid, "user_id": user_id, "seq": seq, "role": "user", "content": user_message,
+         "tokens": estimate_tokens(user_message), "created_at": now},
+        assistant,
+    ]
+    await db.messages.insert_many(messages)
+    return messages
+
+# Fire-and-forget writes (e.g. partial replies after a client disconnect) are
+# kept referenced here until they finish so they are not garbage collected.
+_background_tasks = set()
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def drain_background_tasks():
+    """Wait up to SHUTDOWN_DRAIN_TIMEOUT for outstanding background work, then cancel it."""
+    pending = [task for task in _background_tasks if not task.done()]
+    if pending:
+        _, pending = await asyncio.wait(pending, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+def sse_event(data: Dict[str, Any]) -> str:
+    return f"data: {json.dumps(data)}\n\n"
+
 @app.post("/api/chat")
 async def chat(request: ChatMessage, user_id: str = Depends(get_current_user)):
     """Main chat endpoint with multiple AI provider support"""
     try:
         user_api_keys = await get_user_api_keys(user_id)
-        client, provider = get_ai_client(request.preferred_provider, request.use_fallback, user_api_keys)
+        candidates = get_ai_candidates(request.preferred_provider, request.use_fallback, user_api_keys)
 
-        # Get conversation history
-        conversation = None
-        system_prompt = "You are an advanced AI companion and personal assistant. You excel at:\n\n• Deep reasoning and problem-solving across all domains\n• Creating high-quality content, code, and applications\n• Business strategy, real estate analysis, and market research\n• Personal mentorship and companionship\n• Multi-modal communication (text, voice, analysis)\n• Task automation and workflow optimization\n• Learning from interactions to provide increasingly personalized assistance\n\nYou have access to various tools and APIs. Always provide thoughtful, actionable responses. Be proactive in offering suggestions and anticipating needs. Maintain context across conversations and remember preferences. When appropriate, offer to help with related tasks or provide additional value.\n\nKey capabilities:\n- Code generation and analysis\n- Content creation (blogs, marketing, social media)\n- Research and data analysis\n- Voice interactions and transcription\n- Document processing and analysis\n- Image generation and editing\n- Business automation and task management\n- Real estate market analysis\n- Personal development and mentorship\n\nAlways strive to be the most helpful, intelligent, and reliable AI companion possible."
+        # Only the opening turn of a conversation is cacheable; later turns depend on history.
+        cacheable = chat_cache.enabled and not request.conversation_id
+        cache_scope = f"{user_id}|{model_for_provider(candidates[0][1], request.use_fallback)}"
+        cached = vector = None
+        if cacheable:
+            cached, vector = await chat_cache.lookup(request.message, cache_scope, get_embedding_client(user_api_keys))
 
-        messages = [{"role": "system", "content": system_prompt}]
-
-        if request.conversation_id:
-            conversation = await db.conversations.find_one({"_id": ObjectId(request.conversation_id)})
-            if conversation:
-                messages.extend(conversation.get("messages", []))
-
-        # Add user message
-        messages.append({"role": "user", "content": request.message})
-
-        # Get AI response based on provider
-        if provider == "anthropic":
-            response = client.messages.create(
-                model="claude-3-opus-20240229",
-                max_tokens=2000,
-                temperature=0.7,
-                messages=messages
-            )
-            ai_message = response.content[0].text
+        if cached is not None:
+            conversation, needs_summary = None, False
+            ai_message, provider = cached["response"], cached["provider"]
         else:
-            response = client.chat.completions.create(
-                model=model_for_provider(provider, request.use_fallback),
-                messages=messages,
-                temperature=0.7,
-                max_tokens=2000
-            )
-            ai_message = response.choices[0].message.content
+            conversation, messages, needs_summary = await load_chat_messages(request, candidates[0][1], user_id, user_api_keys)
+            candidates = fitting_candidates(candidates, messages, request.use_fallback)
+            with phase("provider"):
+                ai_message, client, provider = await route_call(
+                    candidates,
+                    lambda client, provider: complete_chat(
+                        client, provider, fit_messages(messages, model_for_provider(provider, request.use_fallback)),
+                        request.use_fallback),
+                    use_fallback=request.use_fallback,
+                    hedge=request.hedge if request.hedge is not None else ROUTER_HEDGE,
+                    tokens=sum(message_tokens(m) for m in messages),
+                )
+            if cacheable:
+                chat_cache.store(request.message, cache_scope, {"response": ai_message, "provider": provider}, vector)
 
-        # Save to database
-        messages.append({"role": "assistant", "content": ai_message})
+        conversation_id = request.conversation_id if conversation else str(ObjectId())
+        await save_chat_turn(conversation_id, user_id, conversation is not None, request.message, ai_message, provider)
+        if needs_summary:
+            run_in_background(summarize_conversation(ObjectId(conversation_id), client, provider))
 
-        if conversation:
-            await db.conversations.update_one(
-                {"_id": ObjectId(request.conversation_id)},
-                {"$set": {"messages": messages, "updated_at": datetime.now(), "provider": provider}}
-            )
+        cache = "hit" if cached is not None else "miss" if cacheable else "bypass"
+        return {"response": ai_message, "conversation_id": conversation_id, "cache": cache}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Chat error: {e}")
+        raise HTTPException(status_code=500, detail="I experienced an error. Please try again later.")
+
+@app.post("/api/chat/stream")
+async def chat_stream(request: ChatMessage, user_id: str = Depends(get_current_user)):
+    """Streaming chat over Server-Sent Events.
+
+    Emits a `start` event with the conversation id, one `delta` event per text
+    chunk and a final `done` event. The reply is persisted once at the end of the
+    stream, or flagged as partial if the client disconnects mid-generation."""
+    try:
+        user_api_keys = await get_user_api_keys(user_id)
+        candidates = get_ai_candidates(request.preferred_provider, request.use_fallback, user_api_keys)
+        conversation, messages, needs_summary = await load_chat_messages(request, candidates[0][1], user_id, user_api_keys)
+        candidates = fitting_candidates(candidates, messages, request.use_fallback)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Chat stream error: {e}")
+        raise HTTPException(status_code=500, detail="I experienced an error. Please try again later.")
+
+    conversation_id = request.conversation_id if conversation else str(ObjectId())
+    exists = conversation is not None
+
+    async def events():
+        chunks = []
+        saved = False
+        client, provider = candidates[0]
+        try:
+            yield sse_event({"type": "start", "conversation_id": conversation_id})
+            with phase("provider"):
+                async for client, provider, delta in route_stream(candidates, messages, request.use_fallback):
+                    chunks.append(delta)
+                    yield sse_event({"type": "delta", "delta": delta})
+            ai_message = "".join(chunks)
+            await save_chat_turn(conversation_id, user_id, exists, request.message, ai_message, provider)
+            saved = True
+            if needs_summary:
+                run_in_background(summarize_conversation(ObjectId(conversation_id), client, provider))
+            yield sse_event({"type": "done", "conversation_id": conversation_id, "response": ai_message, "provider": provider})
+        except AdmissionRejected as e:
+            yield sse_event({"type": "error", "detail": e.detail, "retry_after": round(e.retry_after, 1)})
+        except Exception as e:
+            print(f"Chat stream error: {e}")
+            yield sse_event({"type": "error", "detail": "I experienced an error. Please try again later."})
+        finally:
+            # Client went away (or the provider failed) mid-stream: keep what we have.
+            if not saved and chunks:
+                run_in_background(save_chat_turn(conversation_id, user_id, exists, request.message, "".join(chunks), provider, partial=True))
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# ===== Long-term memory =====
+# Finished chat turns are embedded in the background and stored in db.memories
+# with the vector as raw float32 bytes. Each worker keeps a per-user index: one
+# row-normalised float32 matrix, topped up incrementally from db.memories (so
+# turns saved by other workers show up on the next recall) and searched with a
+# single matrix-vector product; only the MEMORY_MAX_ROWS most recent memories of
+# a user are kept in it. The best hits that are not already part of the
+# conversation's own history are added to the system prompt. A user's recent
+# messages that were never embedded are backfilled once, in the background, the
+# first time any worker loads that user's index. The first full load of an index
+# runs as a background task shielded from MEMORY_RECALL_TIMEOUT: a turn that gives
+# up waiting goes without memories, and later turns pick up the finished load.
+
+MEMORY_ENABLED = os.getenv("MEMORY_ENABLED", "true").lower() == "true"
+MEMORY_EMBEDDING_MODEL = os.getenv("MEMORY_EMBEDDING_MODEL", "text-embedding-3-small")
+MEMORY_TOP_K = int(os.getenv("MEMORY_TOP_K", "4"))
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.35"))
+MEMORY_RECALL_TIMEOUT = float(os.getenv("MEMORY_RECALL_TIMEOUT", "1.5"))
+MEMORY_BACKFILL_LIMIT = int(os.getenv("MEMORY_BACKFILL_LIMIT", "500"))
+MEMORY_MIN_CHARS = 20
+MEMORY_CONTENT_CHARS = 1000
+MEMORY_PROMPT_CHARS = 300
+MEMORY_EMBED_BATCH = 64
+MEMORY_MAX_ROWS = int(os.getenv("MEMORY_MAX_ROWS", "10000"))  # per user; ~60 MB at 1536 dims
+MEMORY_INLINE_SEARCH_ROWS = 5000  # larger indexes are searched off the event loop
+MEMORY_REFRESH_OVERLAP = timedelta(seconds=5)  # ObjectIds from different workers are only ordered per second
+
+class MemoryIndex:
+    """One user's memories as a growable float32 matrix of unit-length rows."""
+
+    def __init__(self):
+        import numpy as np
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.size = 0
+        self.items: List[Dict[str, Any]] = []
+        self.row_ids: List[ObjectId] = []
+        self.ids = set()
+        self.last_id: Optional[ObjectId] = None
+        self.lock = asyncio.Lock()
+        self.loaded = False
+        self.loading: Optional[asyncio.Task] = None
+
+    def add(self, docs: List[Dict[str, Any]]):
+        import numpy as np
+        docs = [d for d in docs if d["_id"] not in self.ids][-MEMORY_MAX_ROWS:]
+        if not docs:
+            return
+        # Drop the oldest rows once over the cap, with some slack so this is not done on every turn.
+        if self.size + len(docs) > MEMORY_MAX_ROWS + MEMORY_MAX_ROWS // 4:
+            keep = max(MEMORY_MAX_ROWS - len(docs), 0)
+            self.vectors[:keep] = self.vectors[self.size - keep : self.size].copy()
+            self.items = self.items[self.size - keep :]
+            self.row_ids = self.row_ids[self.size - keep :]
+            self.ids = set(self.row_ids)
+            self.size = keep
+        rows = np.stack([np.frombuffer(d["embedding"], dtype=np.float32) for d in docs])
+        if self.size + len(rows) > len(self.vectors) or rows.shape[1] != self.vectors.shape[1]:
+            grown = np.zeros((max(2 * len(self.vectors), self.size + len(rows), 64), rows.shape[1]), dtype=np.float32)
+            if self.size:
+                grown[: self.size] = self.vectors[: self.size]
+            self.vectors = grown
+        self.vectors[self.size : self.size + len(rows)] = rows
+        self.size += len(rows)
+        self.items.extend({"conversation_id": d["conversation_id"], "seq": d["seq"], "role": d["role"],
+                           "content": d["content"]} for d in docs)
+        self.row_ids.extend(d["_id"] for d in docs)
+        self.ids.update(d["_id"] for d in docs)
+        newest = max(d["_id"] for d in docs)
+        self.last_id = newest if self.last_id is None else max(self.last_id, newest)
+
+    def search(self, query, k: int) -> List[tuple]:
+        """[(score, item)] for the k most similar rows, best first."""
+        import numpy as np
+        if not self.size:
+            return []
+        scores = self.vectors[: self.size] @ query
+        k = min(k, self.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), self.items[i]) for i in top]
+
+memory_indexes = TTLCache(maxsize=int(os.getenv("MEMORY_INDEX_USERS", "256")), ttl=float(os.getenv("MEMORY_INDEX_TTL", "1800")))
+
+def get_embedding_client(user_api_keys: Dict[str, str]):
+    api_key = (user_api_keys or {}).get("openai") or API_KEYS["openai"]
+    return get_provider_client("openai", api_key) if api_key else None
+
+async def embed_texts(client, texts: List[str]):
+    """Unit-length float32 embeddings, one row per text."""
+    import numpy as np
+    with upstream_call("openai", "embedding"):
+        response = await client.embeddings.create(model=MEMORY_EMBEDDING_MODEL, input=[t[:8000] for t in texts])
+    vectors = np.array([item.embedding for item in response.data], dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+async def store_memories(user_id: str, messages: List[Dict[str, Any]], client):
+    messages = [m for m in messages if len(m["content"].strip()) >= MEMORY_MIN_CHARS]
+    for start in range(0, len(messages), MEMORY_EMBED_BATCH):
+        batch = messages[start : start + MEMORY_EMBED_BATCH]
+        vectors = await embed_texts(client, [m["content"] for m in batch])
+        now = datetime.now()
+        docs = [
+            {"user_id": user_id, "conversation_id": m["conversation_id"], "seq": m["seq"], "role": m["role"],
+             "content": m["content"][:MEMORY_CONTENT_CHARS], "model": MEMORY_EMBEDDING_MODEL,
+             "embedding": vector.tobytes(), "created_at": now}
+            for m, vector in zip(batch, vectors)
+        ]
+        try:
+            await db.memories.insert_many(docs, ordered=False)
+        except BulkWriteError:
+            pass  # some messages were embedded concurrently (backfill racing a live turn)
+
+async def remember_messages(user_id: str, messages: List[Dict[str, Any]]):
+    try:
+        client = get_embedding_client(await get_user_api_keys(user_id))
+        if client is not None:
+            await store_memories(user_id, messages, client)
+    except Exception as e:
+        print(f"Memory error: {e}")
+
+async def backfill_memories(user_id: str, client):
+    try:
+        await db.memory_state.insert_one({"_id": user_id, "backfilled_at": datetime.now()})
+    except DuplicateKeyError:
+        return  # another worker has it
+    try:
+        recent = await db.messages.find(
+            {"user_id": user_id}, {"conversation_id": 1, "seq": 1, "role": 1, "content": 1}
+        ).sort("_id", -1).limit(MEMORY_BACKFILL_LIMIT).to_list(MEMORY_BACKFILL_LIMIT)
+        embedded = {(m["conversation_id"], m["seq"]) async for m in db.memories.find(
+            {"user_id": user_id, "model": MEMORY_EMBEDDING_MODEL}, {"_id": 0, "conversation_id": 1, "seq": 1})}
+        await store_memories(user_id, [m for m in recent if (m["conversation_id"], m["seq"]) not in embedded], client)
+    except Exception as e:
+        print(f"Memory backfill error: {e}")
+
+async def refresh_memory_index(index: MemoryIndex, user_id: str):
+    async with index.lock:
+        query = {"user_id": user_id, "model": MEMORY_EMBEDDING_MODEL}
+        if index.last_id is not None:
+            query["_id"] = {"$gt": ObjectId.from_datetime(index.last_id.generation_time - MEMORY_REFRESH_OVERLAP)}
+        docs = await db.memories.find(query, {"conversation_id": 1, "seq": 1, "role": 1, "content": 1, "embedding": 1}).sort(
+            "_id", -1).limit(MEMORY_MAX_ROWS).to_list(MEMORY_MAX_ROWS)
+        docs.reverse()
+        index.add(docs)
+        index.loaded = True
+
+async def initial_memory_load(index: MemoryIndex, user_id: str):
+    try:
+        await refresh_memory_index(index, user_id)
+    except Exception as e:
+        print(f"Memory index load error: {e}")
+
+async def load_memory_index(user_id: str, client) -> MemoryIndex:
+    """The user's index, topped up with memories stored since the last call. Until the
+       first full load has finished, callers only wait on (never cancel) that load."""
+    index = memory_indexes.get(user_id)
+    if index is None:
+        index = MemoryIndex()
+        memory_indexes.set(user_id, index)
+        run_in_background(backfill_memories(user_id, client))
+    if not index.loaded:
+        if index.loading is None or index.loading.done():  # first call, or the last attempt failed
+            index.loading = run_in_background(initial_memory_load(index, user_id))
+        await asyncio.shield(index.loading)
+        return index
+    await refresh_memory_index(index, user_id)
+    return index
+
+async def recall_memories(user_id: str, text: str, user_api_keys: Dict[str, str]) -> List[tuple]:
+    """Past messages of this user most similar to `text`, as [(score, item)]."""
+    client = get_embedding_client(user_api_keys)
+    if client is None:
+        return []
+    index, vectors = await asyncio.gather(load_memory_index(user_id, client), embed_texts(client, [text]))
+    async with index.lock:
+        if index.size > MEMORY_INLINE_SEARCH_ROWS:
+            hits = await asyncio.to_thread(index.search, vectors[0], MEMORY_TOP_K * 3)
         else:
-            result = await db.conversations.insert_one({
-                "messages": messages,
-                "created_at": datetime.now(),
-                "updated_at": datetime.now(),
-                "provider": provider
-            })
-            request.conversation_id = str(result.inserted_id)
+            hits = index.search(vectors[0], MEMORY_TOP_K * 3)
+    return [hit for hit in hits if hit[0] >= MEMORY_MIN_SCORE]
 
-        return {"response": ai_message, "conversation_id": request.conversation_id}
+def format_memories(hits: List[tuple]) -> str:
+    lines = [f"- {'User' if item['role'] == 'user' else 'Assistant'}: {preview_text(item['content'], MEMORY_PROMPT_CHARS)}"
+             for _, item in hits]
+    return "\n\nRelevant notes from earlier conversations (may be outdated):\n" + "\n".join(lines)
 
+# ===== Response cache =====
+# Opt-in per endpoint. The exact layer is keyed on a hash of the normalised prompt
+# (case and whitespace folded) plus a scope string holding the model, parameters
+# and, for chat, the user, since chat prompts carry that user's memories. With
+# RESPONSE_CACHE_SIMILARITY set, a miss also embeds the prompt and compares it
+# against recently stored prompts in the same scope; the closest one at or above
+# the threshold is served. Similarity rows live in a fixed-size float32 ring
+# buffer, and each row is only valid while its exact entry is still cached, so
+# the TTL and size bounds apply to both layers.
+
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", "0"))  # e.g. 0.95; 0 disables
+
+def cache_flag(endpoint: str) -> bool:
+    return os.getenv(f"RESPONSE_CACHE_{endpoint.upper()}", "false").lower() == "true"
+
+class ResponseCache:
+    """Exact-match response cache with an optional embedding-similarity layer."""
+
+    def __init__(self, endpoint: str, enabled: bool, maxsize: int = RESPONSE_CACHE_SIZE,
+                 ttl: float = RESPONSE_CACHE_TTL, similarity: float = RESPONSE_CACHE_SIMILARITY):
+        self.endpoint = endpoint
+        self.enabled = enabled
+        self.similarity = similarity
+        self.maxsize = maxsize
+        self.exact = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.vectors = None  # (maxsize, dim) float32, allocated on first store
+        self.scope_ids = None
+        self.slot_keys: List[Optional[str]] = [None] * maxsize
+        self.next_slot = 0
+
+    @staticmethod
+    def key(prompt: str, scope: str) -> str:
+        return hashlib.sha256(json.dumps([scope, " ".join(prompt.lower().split())]).encode()).hexdigest()
+
+    @staticmethod
+    def scope_id(scope: str) -> int:
+        return int.from_bytes(hashlib.sha256(scope.encode()).digest()[:8], "little", signed=True)
+
+    async def lookup(self, prompt: str, scope: str, embedding_client=None):
+        """Returns (value, vector). value is None on a miss; vector is the prompt's
+           embedding when the similarity layer ran, to be handed back to store()."""
+        value = self.exact.get(self.key(prompt, scope))
+        if value is not None:
+            RESPONSE_CACHE_LOOKUPS.labels(self.endpoint, "exact_hit").inc()
+            return value, None
+
+        vector = None
+        if self.similarity and embedding_client is not None:
+            try:
+                vector = (await embed_texts(embedding_client, [prompt]))[0]
+            except Exception as e:
+                print(f"Response cache embedding error: {e}")
+            if vector is not None:
+                value = self.nearest(vector, scope)
+        RESPONSE_CACHE_LOOKUPS.labels(self.endpoint, "miss" if value is None else "similar_hit").inc()
+        return value, vector
+
+    def nearest(self, vector, scope: str):
+        import numpy as np
+        if self.vectors is None or self.vectors.shape[1] != len(vector):
+            return None
+        scores = np.where(self.scope_ids == self.scope_id(scope), self.vectors @ vector, -1.0)
+        for slot in np.argsort(-scores)[:4]:
+            if scores[slot] < self.similarity:
+                break
+            value = self.exact.get(self.slot_keys[slot])
+            if value is not None:
+                return value
+        return None
+
+    def store(self, prompt: str, scope: str, value, vector=None):
+        import numpy as np
+        key = self.key(prompt, scope)
+        self.exact.set(key, value)
+        if vector is None:
+            return
+        if self.vectors is None or self.vectors.shape[1] != len(vector):
+            self.vectors = np.zeros((self.maxsize, len(vector)), dtype=np.float32)
+            self.scope_ids = np.zeros(self.maxsize, dtype=np.int64)
+            self.slot_keys = [None] * self.maxsize
+        slot = self.next_slot
+        self.vectors[slot] = vector
+        self.scope_ids[slot] = self.scope_id(scope)
+        self.slot_keys[slot] = key
+        self.next_slot = (slot + 1) % self.maxsize
+
+chat_cache = ResponseCache("chat", cache_flag("chat"))
+research_response_cache = ResponseCache("research", cache_flag("research"))
+name_cache = ResponseCache("name", cache_flag("name"))
+
+# ===== Conversation history =====
+# The history screen lists a user's conversations newest first. Pages are keyset
+# cursors over (updated_at, _id), served straight off the (user_id, updated_at,
+# _id) index, and only the title/snippet fields are read, never the messages.
+# Search uses the (user_id, content) text index on db.messages and returns the
+# conversations with the best-scoring hits. Conversations saved before user_id
+# was recorded have no owner and are not listed.
+
+CONVERSATION_TITLE_CHARS = 80
+CONVERSATION_SNIPPET_CHARS = 160
+CONVERSATION_PAGE_SIZE = 20
+CONVERSATION_MAX_PAGE_SIZE = 100
+CONVERSATION_LIST_FIELDS = {"title": 1, "snippet": 1, "message_count": 1, "provider": 1, "created_at": 1, "updated_at": 1}
+
+def preview_text(text: str, limit: int) -> str:
+    text = " ".join((text or "").split())
+    return text if len(text) <= limit else text[:limit - 1].rstrip() + "…"
+
+def encode_cursor(conversation: Dict[str, Any]) -> str:
+    raw = f"{conversation['updated_at'].isoformat()}|{conversation['_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        updated_at, _id = raw.split("|")
+        return datetime.fromisoformat(updated_at), ObjectId(_id)
+    except (ValueError, InvalidId, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+
+async def search_conversations(user_id: str, query: str, limit: int) -> List[Dict[str, Any]]:
+    hits = db.messages.find(
+        {"user_id": user_id, "$text": {"$search": query}},
+        {"conversation_id": 1, "content": 1, "score": {"$meta": "textScore"}},
+    ).sort([("score", {"$meta": "textScore"})]).limit(limit * 5)
+
+    best = {}
+    async for hit in hits:
+        if hit["conversation_id"] not in best:
+            best[hit["conversation_id"]] = hit
+            if len(best) == limit:
+                break
+    if not best:
+        return []
+
+    found = {c["_id"]: c async for c in db.conversations.find(
+        {"_id": {"$in": list(best)}, "user_id": user_id}, CONVERSATION_LIST_FIELDS)}
+    results = []
+    for cid, hit in best.items():
+        if cid in found:
+            conversation = serialize_doc(found[cid])
+            conversation["match"] = preview_text(hit["content"], CONVERSATION_SNIPPET_CHARS)
+            results.append(conversation)
+    return results
+
+@app.get("/api/conversations")
+async def list_conversations(
+    cursor: Optional[str] = None,
+    limit: int = Query(CONVERSATION_PAGE_SIZE, ge=1, le=CONVERSATION_MAX_PAGE_SIZE),
+    q: Optional[str] = None,
+    user_id: str = Depends(get_current_user),
+):
+    """The caller's conversations, newest first: {"conversations": [...], "next_cursor"}.
+    Pass `next_cursor` back as `cursor` for the next page. With `q`, returns the
+    conversations whose messages best match the search text (single page)."""
+    try:
+        with phase("history"):
+            if q and q.strip():
+                return {"conversations": await search_conversations(user_id, q.strip(), limit), "next_cursor": None}
+
+            query: Dict[str, Any] = {"user_id": user_id}
+            if cursor:
+                updated_at, last_id = decode_cursor(cursor)
+                query["$or"] = [
+                    {"updated_at": {"$lt": updated_at}},
+                    {"updated_at": updated_at, "_id": {"$lt": last_id}},
+                ]
+            page = await db.conversations.find(query, CONVERSATION_LIST_FIELDS).sort(
+                [("updated_at", -1), ("_id", -1)]).limit(limit + 1).to_list(limit + 1)
+
+        next_cursor = encode_cursor(page[limit - 1]) if len(page) > limit else None
+        return {"conversations": [serialize_doc(c) for c in page[:limit]], "next_cursor": next_cursor}
+    except HTTPException:
+        raise
     except Exception as e:
-        print(f"Chat error: {e}")
-        raise HTTPException(status_code=500, detail=f"I experienced an error. Please try again later.")
+        print(f"Conversation history error: {e}")
+        raise HTTPException(status_code=500, detail="Failed to load conversations")
+
+# ===== Batch prompts =====
+# Multi-tool dashboards send several independent prompts at once. A batch pays
+# for auth and the settings lookup once, runs its jobs concurrently through the
+# normal router (so failover and admission control apply per job) and streams
+# each result back as soon as it is ready. A failing job is reported on its own
+# line and does not affect the rest of the batch. Keeping BATCH_CONCURRENCY at or
+# below ADMISSION_USER_QUEUE means jobs over the caller's rate limit wait for
+# capacity instead of being rejected.
+
+BATCH_MAX_JOBS = int(os.getenv("BATCH_MAX_JOBS", "20"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+async def run_batch_job(index: int, job: BatchJob, user_api_keys: Dict[str, str], semaphore: asyncio.Semaphore):
+    job_id = job.id if job.id is not None else str(index)
+    messages = [{"role": "system", "content": job.system_prompt or CHAT_SYSTEM_PROMPT},
+                {"role": "user", "content": job.prompt}]
+
+    def call(client, provider):
+        model = job.model if provider == job.preferred_provider else None
+        return complete_chat(client, provider, messages, job.use_fallback,
+                             max_tokens=job.max_tokens or CHAT_MAX_TOKENS, temperature=job.temperature, model=model)
+
+    started = time.monotonic()
+    try:
+        async with semaphore:
+            candidates = get_ai_candidates(job.preferred_provider, job.use_fallback, user_api_keys)
+            response, _, provider = await route_call(candidates, call, use_fallback=job.use_fallback,
+                                                     tokens=sum(message_tokens(m) for m in messages))
+    except HTTPException as e:
+        result = {"id": job_id, "index": index, "status": e.status_code, "error": e.detail}
+        if isinstance(e, AdmissionRejected):
+            result["retry_after"] = round(e.retry_after, 1)
+        return result
+    except Exception as e:
+        print(f"Batch job error: {e}")
+        return {"id": job_id, "index": index, "status": 502, "error": "The provider failed to answer this prompt."}
+    return {"id": job_id, "index": index, "status": 200, "response": response, "provider": provider,
+            "elapsed": round(time.monotonic() - started, 3)}
+
+@app.post("/api/batch")
+async def run_batch(request: BatchRequest, user_id: str = Depends(get_current_user)):
+    """Run several prompts concurrently. Results are streamed back as NDJSON, one
+    line per job in completion order: {"id", "index", "status", "response",
+    "provider"} on success or {"id", "index", "status", "error"} on failure."""
+    if not request.jobs:
+        raise HTTPException(status_code=400, detail="A batch needs at least one job.")
+    if len(request.jobs) > BATCH_MAX_JOBS:
+        raise HTTPException(status_code=400, detail=f"A batch can hold at most {BATCH_MAX_JOBS} jobs.")
+    user_api_keys = await get_user_api_keys(user_id)
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def lines():
+        tasks = [asyncio.create_task(run_batch_job(i, job, user_api_keys, semaphore)) for i, job in enumerate(request.jobs)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson", headers={"X-Accel-Buffering": "no"})
+
+# ===== Transcription =====
+# Uploads stay in memory; nothing is written to a fixed path. Long recordings are
+# decoded to mono PCM (WAV natively, other formats through ffmpeg over pipes when
+# it is installed), cut at the quietest point near every
+# TRANSCRIBE_SEGMENT_SECONDS, transcribed concurrently and stitched back in order.
+# If the audio cannot be decoded here it is sent to Whisper as a single request.
+
+TRANSCRIBE_SAMPLE_RATE = 16000
+TRANSCRIBE_SEGMENT_SECONDS = float(os.getenv("TRANSCRIBE_SEGMENT_SECONDS", "60"))
+TRANSCRIBE_CONCURRENCY = int(os.getenv("TRANSCRIBE_CONCURRENCY", "4"))
+FFMPEG_PATH = shutil.which("ffmpeg")
+
+def read_wav_pcm(data: bytes):
+    """(mono int16 samples, sample rate) for 16-bit PCM WAV, else None."""
+    import numpy as np
+    try:
+        with wave.open(io.BytesIO(data)) as wav:
+            if wav.getsampwidth() != 2:
+                return None
+            channels, rate = wav.getnchannels(), wav.getframerate()
+            samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+    except (wave.Error, EOFError):
+        return None
+    if channels > 1:
+        samples = samples[: len(samples) // channels * channels].reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return samples, rate
+
+async def decode_audio(data: bytes):
+    """(mono int16 samples, sample rate) or None if the format can't be decoded here."""
+    decoded = await asyncio.to_thread(read_wav_pcm, data)
+    if decoded is not None or not FFMPEG_PATH:
+        return decoded
+    import numpy as np
+    proc = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, "-nostdin", "-loglevel", "error", "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-ar", str(TRANSCRIBE_SAMPLE_RATE), "pipe:1",
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+    )
+    out, _ = await proc.communicate(data)
+    if proc.returncode != 0 or not out:
+        return None
+    return np.frombuffer(out, dtype=np.int16), TRANSCRIBE_SAMPLE_RATE
+
+def split_at_silence(samples, rate: int, target_seconds: float) -> List[bytes]:
+    """Cut samples into WAV segments of at most ~target_seconds, each ending at the
+       quietest 30 ms frame in the second half of its window."""
+    import numpy as np
+    frame = max(1, int(rate * 0.03))
+    target = int(target_seconds * rate)
+    n_frames = len(samples) // frame
+    rms = np.sqrt(np.mean(samples[: n_frames * frame].astype(np.float32).reshape(n_frames, frame) ** 2, axis=1))
+
+    bounds = [0]
+    while len(samples) - bounds[-1] > target * 1.25:
+        lo = (bounds[-1] + target // 2) // frame
+        hi = (bounds[-1] + target) // frame
+        quietest = lo + int(np.argmin(rms[lo:hi]))
+        bounds.append(quietest * frame + frame // 2)
+    bounds.append(len(samples))
+
+    segments = []
+    for start, end in zip(bounds, bounds[1:]):
+        out = io.BytesIO()
+        with wave.open(out, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(rate)
+            wav.writeframes(samples[start:end].tobytes())
+        segments.append(out.getvalue())
+    return segments
+
+async def transcribe_bytes(client, data: bytes, filename: str, content_type: Optional[str] = None) -> str:
+    """Transcribe an in-memory recording, splitting long audio into concurrent segments."""
+    segments = None
+    decoded = await decode_audio(data)
+    if decoded is not None:
+        samples, rate = decoded
+        if len(samples) > TRANSCRIBE_SEGMENT_SECONDS * rate * 1.25:
+            segments = await asyncio.to_thread(split_at_silence, samples, rate, TRANSCRIBE_SEGMENT_SECONDS)
+
+    if not segments:
+        with upstream_call("openai", "transcription"):
+            transcript = await client.audio.transcriptions.create(
+                model="whisper-1",
+                file=(filename, data, content_type or "application/octet-stream")
+            )
+        return transcript.text
+
+    semaphore = asyncio.Semaphore(TRANSCRIBE_CONCURRENCY)
+
+    async def transcribe_segment(index: int, segment: bytes) -> str:
+        async with semaphore:
+            with upstream_call("openai", "transcription"):
+                transcript = await client.audio.transcriptions.create(
+                    model="whisper-1",
+                    file=(f"segment-{index}.wav", segment, "audio/wav")
+                )
+            return transcript.text.strip()
+
+    texts = await asyncio.gather(*(transcribe_segment(i, segment) for i, segment in enumerate(segments)))
+    return " ".join(text for text in texts if text)
 
 @app.post("/api/voice/transcribe")
 async def transcribe_audio(audio: UploadFile = File(...), use_fallback: bool = Form(False), preferred_provider: Optional[str] = Form(None), user_id: str = Depends(get_current_user)):
@@ -256,24 +2033,69 @@ async def transcribe_audio(audio: UploadFile = File(...), use_fallback: bool = F
         user_api_keys = await get_user_api_keys(user_id)
         client, provider = get_ai_client(preferred_provider, use_fallback, user_api_keys)
         audio_data = await audio.read()
-        
-        temp_path = f"/tmp/{audio.filename}"
-        with open(temp_path, "wb") as f:
-            f.write(audio_data)
-
-        with open(temp_path, "rb") as audio_file:
-            transcript = client.audio.transcriptions.create(
-                model="whisper-1", 
-                file=audio_file
-            )
-        
-        os.remove(temp_path)
-        return {"transcript": transcript.text}
+
+        text = await transcribe_bytes(client, audio_data, os.path.basename(audio.filename or "audio.webm"), audio.content_type)
+        return {"transcript": text}
 
     except Exception as e:
         print(f"Transcription error: {e}")
         raise HTTPException(status_code=500, detail=f"Transcription error: {str(e)}")
 
+# ===== Text to speech =====
+# Synthesized audio is cached by sha256(model, voice, text), so repeated phrases
+# (greetings, the assistant's name) are served without a provider call. The
+# streaming endpoint splits text into sentences and synthesizes up to
+# TTS_PIPELINE_DEPTH of them ahead, so playback starts after the first sentence.
+
+TTS_MODEL = "tts-1"
+TTS_PIPELINE_DEPTH = int(os.getenv("TTS_PIPELINE_DEPTH", "3"))
+TTS_MIN_SENTENCE_CHARS = 20
+
+tts_cache = TTLCache(maxsize=int(os.getenv("TTS_CACHE_SIZE", "500")), ttl=float(os.getenv("TTS_CACHE_TTL", "86400")))
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+def split_sentences(text: str) -> List[str]:
+    """Split text into sentences, merging fragments shorter than TTS_MIN_SENTENCE_CHARS
+       into the following sentence."""
+    sentences = []
+    carry = ""
+    for part in SENTENCE_END.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        carry = f"{carry} {part}" if carry else part
+        if len(carry) >= TTS_MIN_SENTENCE_CHARS:
+            sentences.append(carry)
+            carry = ""
+    if carry:
+        sentences.append(carry)
+    return sentences
+
+async def synthesize_speech(client, text: str, voice: str, model: str = TTS_MODEL) -> bytes:
+    key = hashlib.sha256(f"{model}\0{voice}\0{text}".encode("utf-8")).hexdigest()
+    audio = tts_cache.get(key)
+    if audio is None:
+        with upstream_call("openai", "speech"):
+            response = await client.audio.speech.create(model=model, voice=voice, input=text)
+        audio = response.content
+        tts_cache.set(key, audio)
+    return audio
+
+async def stream_speech(client, sentences: List[str], voice: str):
+    """Yield MP3 audio per sentence in order, synthesizing a few sentences ahead."""
+    remaining = iter(sentences)
+    pending = deque(asyncio.create_task(synthesize_speech(client, s, voice)) for s in itertools.islice(remaining, TTS_PIPELINE_DEPTH))
+    try:
+        while pending:
+            audio = await pending.popleft()
+            sentence = next(remaining, None)
+            if sentence is not None:
+                pending.append(asyncio.create_task(synthesize_speech(client, sentence, voice)))
+            yield audio
+    finally:
+        for task in pending:
+            task.cancel()
+
 @app.post("/api/voice/speak")
 async def text_to_speech(text: str = Form(...), voice: str = Form("nova"), use_fallback: bool = Form(False), preferred_provider: Optional[str] = Form(None), user_id: str = Depends(get_current_user)):
     """Convert text to speech using OpenAI TTS"""
@@ -282,12 +2104,8 @@ async def text_to_speech(text: str = Form(...), voice: str = Form("nova"), use_f
         client, provider = get_ai_client(preferred_provider, use_fallback, user_api_keys)
         
         if provider == "openai":
-            response = client.audio.speech.create(
-                model="tts-1",
-                voice=voice,
-                input=text
-            )
-            audio_base64 = base64.b64encode(response.content).decode("utf-8")
+            audio = await synthesize_speech(client, text, voice)
+            audio_base64 = base64.b64encode(audio).decode("utf-8")
             return {"audio_base64": audio_base64}
         else:
             raise HTTPException(status_code=400, detail=f"{provider} does not support text-to-speech.")
@@ -296,6 +2114,207 @@ async def text_to_speech(text: str = Form(...), voice: str = Form("nova"), use_f
         print(f"TTS error: {e}")
         raise HTTPException(status_code=500, detail=f"TTS error: {str(e)}")
 
+@app.post("/api/voice/speak/stream")
+async def text_to_speech_stream(text: str = Form(...), voice: str = Form("nova"), use_fallback: bool = Form(False), preferred_provider: Optional[str] = Form(None), user_id: str = Depends(get_current_user)):
+    """Stream raw audio/mpeg, synthesized sentence by sentence."""
+    user_api_keys = await get_user_api_keys(user_id)
+    client, provider = get_ai_client(preferred_provider, use_fallback, user_api_keys)
+    if provider != "openai":
+        raise HTTPException(status_code=400, detail=f"{provider} does not support text-to-speech.")
+
+    # Synthesize the first sentence before committing to a 200, so a rejected key or
+    # an unavailable provider is reported as an error status instead of empty audio.
+    speech = stream_speech(client, split_sentences(text), voice)
+    try:
+        first = await anext(speech, None)
+    except Exception as e:
+        await speech.aclose()
+        print(f"TTS error: {e}")
+        status = getattr(e, "status_code", None)
+        if status == 429:
+            raise HTTPException(status_code=429, detail="Text-to-speech is rate limited. Please try again shortly.")
+        if is_availability_error(e):
+            raise HTTPException(status_code=503, detail="Text-to-speech is temporarily unavailable.")
+        raise HTTPException(status_code=400 if status and status < 500 else 500, detail=f"TTS error: {str(e)}")
+
+    async def audio():
+        try:
+            if first is not None:
+                yield first
+            async for chunk in speech:
+                yield chunk
+        except Exception as e:
+            print(f"TTS error: {e}")
+            raise  # aborts the response so the client sees truncated audio as a failure
+        finally:
+            await speech.aclose()
+
+    return StreamingResponse(audio(), media_type="audio/mpeg")
+
+# ===== Voice session (WebSocket) =====
+# One socket per voice conversation: auth and settings are resolved once at
+# connect. Per utterance the client sends binary audio frames followed by
+# {"type": "end"}; the server replies with {"type": "transcript"}, streams
+# {"type": "delta"} chat tokens and, for every finished sentence, an
+# {"type": "audio", "index", "sentence"} header followed by one binary MP3 frame,
+# then {"type": "done"}. TTS for a sentence starts while the model is still
+# generating the rest of the reply.
+#
+# Other client messages: {"type": "start", ...options} sets voice,
+# conversation_id, preferred_provider or use_fallback and discards buffered
+# audio; {"type": "text", "message"} runs a turn without transcription.
+
+VOICE_MAX_BYTES = int(os.getenv("VOICE_MAX_BYTES", str(25 * 1024 * 1024)))
+VOICE_OPTION_TYPES = {
+    "voice": (str,),
+    "conversation_id": (str, type(None)),
+    "preferred_provider": (str, type(None)),
+    "use_fallback": (bool,),
+}
+
+def pop_complete_sentences(buffer: str):
+    """Split streamed text into (finished sentences, unfinished remainder)."""
+    last = None
+    for last in SENTENCE_END.finditer(buffer):
+        pass
+    if last is None:
+        return [], buffer
+    return split_sentences(buffer[:last.start()]), buffer[last.end():]
+
+async def send_speech(websocket: WebSocket, queue: asyncio.Queue):
+    index = 0
+    while (item := await queue.get()) is not None:
+        sentence, task = item
+        try:
+            audio = await task
+        except Exception as e:
+            print(f"TTS error: {e}")
+            continue
+        await websocket.send_json({"type": "audio", "index": index, "sentence": sentence})
+        await websocket.send_bytes(audio)
+        index += 1
+
+async def run_voice_turn(websocket: WebSocket, user_id: str, user_api_keys: Dict[str, str], options: Dict[str, Any],
+                         audio: Optional[bytes] = None, filename: Optional[str] = None, text: Optional[str] = None):
+    candidates = get_ai_candidates(options["preferred_provider"], options["use_fallback"], user_api_keys)
+    speech_client = next((client for client, provider in candidates if provider == "openai"), None)
+
+    if audio is not None:
+        text = await transcribe_bytes(speech_client or candidates[0][0], audio, os.path.basename(filename or "audio.webm"))
+        await websocket.send_json({"type": "transcript", "text": text})
+    text = (text or "").strip()
+    if not text:
+        await websocket.send_json({"type": "error", "detail": "No speech detected."})
+        return
+
+    request = ChatMessage(message=text, conversation_id=options["conversation_id"],
+                          use_fallback=options["use_fallback"], preferred_provider=options["preferred_provider"])
+    conversation, messages, needs_summary = await load_chat_messages(request, candidates[0][1], user_id, user_api_keys)
+    candidates = fitting_candidates(candidates, messages, options["use_fallback"])
+    conversation_id = request.conversation_id if conversation else str(ObjectId())
+    exists = conversation is not None
+
+    speech = asyncio.Queue()
+    speaker = asyncio.create_task(send_speech(websocket, speech))
+    chunks = []
+    buffer = ""
+    saved = False
+    client, provider = candidates[0]
+
+    def speak(sentences: List[str]):
+        if speech_client is None:
+            return
+        for sentence in sentences:
+            speech.put_nowait((sentence, asyncio.create_task(synthesize_speech(speech_client, sentence, options["voice"]))))
+
+    try:
+        async for client, provider, delta in route_stream(candidates, messages, request.use_fallback):
+            chunks.append(delta)
+            await websocket.send_json({"type": "delta", "delta": delta})
+            sentences, buffer = pop_complete_sentences(buffer + delta)
+            speak(sentences)
+        speak(split_sentences(buffer))
+        speech.put_nowait(None)
+
+        ai_message = "".join(chunks)
+        await save_chat_turn(conversation_id, user_id, exists, text, ai_message, provider)
+        saved = True
+        options["conversation_id"] = conversation_id
+        if needs_summary:
+            run_in_background(summarize_conversation(ObjectId(conversation_id), client, provider))
+
+        await speaker
+        await websocket.send_json({"type": "done", "conversation_id": conversation_id, "response": ai_message,
+                                   "provider": provider, "audio": speech_client is not None})
+    finally:
+        if not speaker.done():
+            speaker.cancel()
+        while not speech.empty():
+            item = speech.get_nowait()
+            if item is not None:
+                item[1].cancel()
+        if not saved and chunks:
+            run_in_background(save_chat_turn(conversation_id, user_id, exists, text, "".join(chunks), provider, partial=True))
+
+@app.websocket("/api/voice/session")
+async def voice_session(websocket: WebSocket, token: str = Query(...)):
+    """Single-connection voice pipeline: audio up; transcript, tokens and speech down."""
+    try:
+        user_id = verify_token(token)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+    _current_user.set(user_id)
+    await websocket.accept()
+
+    user_api_keys = await get_user_api_keys(user_id)
+    options = {"voice": "nova", "conversation_id": None, "preferred_provider": None, "use_fallback": False}
+    audio = bytearray()
+    await websocket.send_json({"type": "ready"})
+
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes") is not None:
+                audio.extend(message["bytes"])
+                if len(audio) > VOICE_MAX_BYTES:
+                    audio.clear()
+                    await websocket.send_json({"type": "error", "detail": "Recording is too large."})
+                continue
+
+            try:
+                try:
+                    data = json.loads(message.get("text") or "{}")
+                except ValueError:
+                    data = None
+                if not isinstance(data, dict):
+                    raise HTTPException(status_code=400, detail="Messages must be JSON objects.")
+                kind = data.get("type")
+                if kind == "start":
+                    update = {key: data[key] for key in options if key in data}
+                    invalid = [key for key, value in update.items() if not isinstance(value, VOICE_OPTION_TYPES[key])]
+                    if invalid:
+                        raise HTTPException(status_code=400, detail=f"Invalid option: {', '.join(invalid)}")
+                    options.update(update)
+                    audio.clear()
+                elif kind == "end":
+                    payload = bytes(audio)
+                    audio.clear()
+                    await run_voice_turn(websocket, user_id, user_api_keys, options, audio=payload, filename=data.get("filename"))
+                elif kind == "text":
+                    await run_voice_turn(websocket, user_id, user_api_keys, options, text=data.get("message"))
+            except WebSocketDisconnect:
+                raise
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "detail": e.detail})
+            except Exception as e:
+                print(f"Voice session error: {e}")
+                await websocket.send_json({"type": "error", "detail": "I experienced an error. Please try again later."})
+    except WebSocketDisconnect:
+        pass
+
 @app.post("/api/image/generate")
 async def generate_image(request: ImageGenerationRequest, user_id: str = Depends(get_current_user)):
     """Generate images using DALL-E 3"""
@@ -305,11 +2324,11 @@ async def generate_image(request: ImageGenerationRequest, user_id: str = Depends
         if provider != "openai":
             raise HTTPException(status_code=400, detail=f"{provider} does not support image generation. Please use OpenAI.")
         
-        response = client.images.generate(
+        response = await client.images.generate(
             model="dall-e-3",
             prompt=request.prompt,
             size=request.size,
-            quality="hd",
+            quality=request.quality,
             n=1,
         )
         image_url = response.data[0].url
@@ -319,27 +2338,266 @@ async def generate_image(request: ImageGenerationRequest, user_id: str = Depends
         print(f"Image generation error: {e}")
         raise HTTPException(status_code=500, detail=f"Image generation error: {str(e)}")
 
-@app.post("/api/document/analyze")
-async def analyze_document(request: DocumentAnalysisRequest, user_id: str = Depends(get_current_user)):
-    """Analyze documents/images using GPT-4o Vision"""
+# ===== Image generation jobs =====
+# POST /api/image/jobs stores a job in db.image_jobs and returns immediately;
+# clients poll GET /api/image/jobs/{id}. Workers claim queued jobs atomically
+# from Mongo (so any worker process can pick them up, and jobs survive restarts)
+# and cap concurrent provider calls per provider. Generated images are stored in
+# GridFS and served from /api/image/files/{token}, so links never expire. The
+# token is random and issued per job, so a link only works for whoever was given
+# it. Finished results are reused for identical (prompt, size, quality) submissions.
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "4"))
+IMAGE_PROVIDER_CONCURRENCY = {"openai": int(os.getenv("IMAGE_OPENAI_CONCURRENCY", "2"))}
+IMAGE_POLL_INTERVAL = float(os.getenv("IMAGE_POLL_INTERVAL", "2"))
+IMAGE_JOB_TIMEOUT = float(os.getenv("IMAGE_JOB_TIMEOUT", "600"))
+
+_image_jobs_ready = asyncio.Event()
+_image_workers_stopping = asyncio.Event()
+_image_semaphores: Dict[str, asyncio.Semaphore] = {}
+_image_workers: List[asyncio.Task] = []
+
+def images_bucket():
+    return motor.motor_asyncio.AsyncIOMotorGridFSBucket(db, bucket_name="images")
+
+def image_cache_key(prompt: str, size: str, quality: str) -> str:
+    normalized = " ".join(prompt.split()).lower()
+    return hashlib.sha256(f"{normalized}\0{size}\0{quality}".encode("utf-8")).hexdigest()
+
+def image_semaphore(provider: str) -> asyncio.Semaphore:
+    semaphore = _image_semaphores.get(provider)
+    if semaphore is None:
+        semaphore = _image_semaphores[provider] = asyncio.Semaphore(IMAGE_PROVIDER_CONCURRENCY.get(provider, 1))
+    return semaphore
+
+def serialize_image_job(job: Dict[str, Any]) -> Dict[str, Any]:
+    result = {
+        "job_id": str(job["_id"]),
+        "status": job["status"],
+        "prompt": job["prompt"],
+        "size": job["size"],
+        "quality": job["quality"],
+        "cached": job.get("cached", False),
+    }
+    if job.get("image_id") and job.get("file_token"):
+        result["image_url"] = f"/api/image/files/{job['file_token']}"
+    if job.get("error"):
+        result["error"] = job["error"]
+    return result
+
+async def claim_image_job():
+    """Atomically take the oldest queued job (or one whose worker died mid-run)."""
+    now = datetime.now()
+    return await db.image_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued"},
+            {"status": "running", "updated_at": {"$lt": now - timedelta(seconds=IMAGE_JOB_TIMEOUT)}},
+        ]},
+        {"$set": {"status": "running", "updated_at": now}},
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+async def run_image_job(job: Dict[str, Any]):
     try:
-        user_api_keys = await get_user_api_keys(user_id)
-        client, provider = get_ai_client(request.preferred_provider, request.use_fallback, user_api_keys)
-        
-        response = client.chat.completions.create(
-            model=model_for_provider(provider, request.use_fallback),
+        user_api_keys = await get_user_api_keys(job["user_id"])
+        client, provider = get_ai_client(job.get("preferred_provider"), job.get("use_fallback", False), user_api_keys)
+        if provider != "openai":
+            raise ValueError(f"{provider} does not support image generation. Please use OpenAI.")
+
+        async with image_semaphore(provider):
+            with upstream_call(provider, "image"):
+                response = await client.images.generate(
+                    model="dall-e-3",
+                    prompt=job["prompt"],
+                    size=job["size"],
+                    quality=job["quality"],
+                    n=1,
+                    response_format="b64_json",
+                )
+        data = await asyncio.to_thread(base64.b64decode, response.data[0].b64_json)
+        image_id = await images_bucket().upload_from_stream(
+            f"{job['cache_key']}.png", data, metadata={"cache_key": job["cache_key"], "content_type": "image/png"}
+        )
+        await db.image_jobs.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"status": "done", "image_id": image_id, "provider": provider, "updated_at": datetime.now()}}
+        )
+    except Exception as e:
+        print(f"Image job error: {e}")
+        await db.image_jobs.update_one(
+            {"_id": job["_id"]},
+            {"$set": {"status": "failed", "error": str(e), "updated_at": datetime.now()}}
+        )
+
+async def image_worker():
+    while not _image_workers_stopping.is_set():
+        try:
+            _image_jobs_ready.clear()
+            job = await claim_image_job()
+            if job is None:
+                try:
+                    await asyncio.wait_for(_image_jobs_ready.wait(), IMAGE_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await run_image_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Image worker error: {e}")
+            await asyncio.sleep(IMAGE_POLL_INTERVAL)
+
+async def ensure_image_job_indexes():
+    await db.image_jobs.create_index([("status", 1), ("created_at", 1)])
+    await db.image_jobs.create_index([("cache_key", 1), ("status", 1)])
+    await db.image_jobs.create_index("file_token", unique=True, sparse=True)
+
+def start_image_workers():
+    _image_workers_stopping.clear()
+    for _ in range(IMAGE_WORKERS):
+        _image_workers.append(run_in_background(image_worker()))
+
+async def stop_image_workers():
+    """Let running jobs finish within SHUTDOWN_DRAIN_TIMEOUT; idle workers exit at once.
+       Jobs cut off after that are reclaimed by another worker after IMAGE_JOB_TIMEOUT."""
+    _image_workers_stopping.set()
+    _image_jobs_ready.set()
+    if _image_workers:
+        _, pending = await asyncio.wait(_image_workers, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+    _image_workers.clear()
+
+@app.post("/api/image/jobs")
+async def submit_image_job(request: ImageGenerationRequest, user_id: str = Depends(get_current_user)):
+    """Queue an image generation job. Identical finished requests are answered from storage."""
+    cache_key = image_cache_key(request.prompt, request.size, request.quality)
+    now = datetime.now()
+    job = {
+        "user_id": user_id,
+        "prompt": request.prompt,
+        "size": request.size,
+        "quality": request.quality,
+        "preferred_provider": request.preferred_provider,
+        "use_fallback": request.use_fallback,
+        "cache_key": cache_key,
+        "file_token": secrets.token_urlsafe(24),
+        "status": "queued",
+        "created_at": now,
+        "updated_at": now,
+    }
+
+    previous = await db.image_jobs.find_one({"cache_key": cache_key, "status": "done"}, {"image_id": 1, "provider": 1})
+    if previous:
+        job.update({"status": "done", "image_id": previous["image_id"], "provider": previous.get("provider"), "cached": True})
+
+    result = await db.image_jobs.insert_one(job)
+    job["_id"] = result.inserted_id
+    if job["status"] == "queued":
+        _image_jobs_ready.set()
+    return serialize_image_job(job)
+
+@app.get("/api/image/jobs/{job_id}")
+async def get_image_job(job_id: str, user_id: str = Depends(get_current_user)):
+    try:
+        job = await db.image_jobs.find_one({"_id": ObjectId(job_id), "user_id": user_id})
+    except InvalidId:
+        job = None
+    if not job:
+        raise HTTPException(status_code=404, detail="Image job not found")
+    if not job.get("file_token"):  # jobs stored before links were tokenized
+        job["file_token"] = secrets.token_urlsafe(24)
+        await db.image_jobs.update_one({"_id": job["_id"]}, {"$set": {"file_token": job["file_token"]}})
+    return serialize_image_job(job)
+
+@app.get("/api/image/files/{token}")
+async def get_image_file(token: str):
+    """Serve a stored image by its job's file token. Content is immutable, so clients may cache it indefinitely."""
+    job = await db.image_jobs.find_one({"file_token": token, "image_id": {"$exists": True}}, {"image_id": 1})
+    if not job:
+        raise HTTPException(status_code=404, detail="Image not found")
+    try:
+        stream = await images_bucket().open_download_stream(job["image_id"])
+    except NoFile:
+        raise HTTPException(status_code=404, detail="Image not found")
+
+    async def body():
+        while chunk := await stream.readchunk():
+            yield chunk
+
+    content_type = (stream.metadata or {}).get("content_type", "image/png")
+    return StreamingResponse(body(), media_type=content_type, headers={"Cache-Control": "private, max-age=31536000, immutable"})
+
+# ===== Document analysis =====
+# Images are decoded, downscaled to the vision model's useful resolution (fit in
+# 2048px, shortest side at most 768px) and recompressed off the event loop.
+# Only OpenAI-compatible providers whose model accepts images are routed to.
+# Analyses are cached by (sha256 of the original bytes, prompt, model), so
+# re-analysing the same document with the same prompt and model does not call
+# the provider again.
+
+DOCUMENT_MAX_BYTES = int(os.getenv("DOCUMENT_MAX_BYTES", str(20 * 1024 * 1024)))
+DOCUMENT_MAX_SIDE = 2048
+DOCUMENT_MAX_SHORT_SIDE = 768
+DOCUMENT_JPEG_QUALITY = 85
+DOCUMENT_IMAGE_TOKENS = 1500  # high-detail vision cost of a DOCUMENT_MAX_SIDE x DOCUMENT_MAX_SHORT_SIDE image
+VISION_PROVIDERS = {"openai", "aimlapi", "emergent_llm"}  # served by gpt-4o / gpt-4o-mini
+
+analysis_cache = TTLCache(maxsize=int(os.getenv("ANALYSIS_CACHE_SIZE", "500")), ttl=float(os.getenv("ANALYSIS_CACHE_TTL", "86400")))
+
+def prepare_document_image(data: bytes) -> bytes:
+    """Downscale and recompress an uploaded image to JPEG. Runs in a worker thread."""
+    from PIL import Image, ImageOps
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        scale = min(1.0, DOCUMENT_MAX_SIDE / max(image.size), DOCUMENT_MAX_SHORT_SIDE / min(image.size))
+        if scale < 1.0:
+            size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+            image = image.resize(size, Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+            # JPEG has no alpha; flatten onto white so dark text on a transparent background stays legible.
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        out = io.BytesIO()
+        image.save(out, "JPEG", quality=DOCUMENT_JPEG_QUALITY, optimize=True)
+        return out.getvalue()
+
+async def analyze_image(image_bytes: bytes, prompt: str, preferred_provider: Optional[str], use_fallback: bool, user_id: str):
+    user_api_keys = await get_user_api_keys(user_id)
+    candidates = [c for c in get_ai_candidates(preferred_provider, use_fallback, user_api_keys) if c[1] in VISION_PROVIDERS]
+    if not candidates:
+        raise HTTPException(status_code=400, detail="No vision-capable provider found. Add an OpenAI key in Settings.")
+
+    digest = await asyncio.to_thread(lambda: hashlib.sha256(image_bytes).hexdigest())
+    cached = analysis_cache.get((digest, prompt, model_for_provider(candidates[0][1], use_fallback)))
+    if cached is not None:
+        return {"analysis": cached, "cached": True}
+
+    try:
+        jpeg = await asyncio.to_thread(prepare_document_image, image_bytes)
+    except (OSError, ValueError):  # PIL's UnidentifiedImageError is an OSError
+        raise HTTPException(status_code=400, detail="Unsupported or corrupt image.")
+    image_base64 = base64.b64encode(jpeg).decode("utf-8")
+
+    async def analyze(client, provider):
+        response = await client.chat.completions.create(
+            model=model_for_provider(provider, use_fallback),
             messages=[
                 {
                     "role": "user",
                     "content": [
                         {
                             "type": "text",
-                            "text": request.prompt
+                            "text": prompt
                         },
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{request.image_base64}"
+                                "url": f"data:image/jpeg;base64,{image_base64}"
                             }
                         }
                     ]
@@ -347,17 +2605,207 @@ async def analyze_document(request: DocumentAnalysisRequest, user_id: str = Depe
             ],
             max_tokens=2000
         )
-        return {"analysis": response.choices[0].message.content}
+        record_usage(provider, response)
+        return response.choices[0].message.content
+
+    analysis, _, provider = await route_call(candidates, analyze, use_fallback=use_fallback,
+                                             tokens=estimate_tokens(prompt) + DOCUMENT_IMAGE_TOKENS)
+    analysis_cache.set((digest, prompt, model_for_provider(provider, use_fallback)), analysis)
+    return {"analysis": analysis, "cached": False}
 
+@app.post("/api/document/analyze")
+async def analyze_document(request: DocumentAnalysisRequest, user_id: str = Depends(get_current_user)):
+    """Analyze documents/images using GPT-4o Vision"""
+    try:
+        image_bytes = await asyncio.to_thread(base64.b64decode, request.image_base64)
+        return await analyze_image(image_bytes, request.prompt, request.preferred_provider, request.use_fallback, user_id)
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Document analysis error: {e}")
+        raise HTTPException(status_code=500, detail=f"Document analysis error: {str(e)}")
+
+@app.post("/api/document/analyze/upload")
+async def analyze_document_upload(file: UploadFile = File(...), prompt: str = Form(...), use_fallback: bool = Form(False), preferred_provider: Optional[str] = Form(None), user_id: str = Depends(get_current_user)):
+    """Analyze an image sent as a multipart file upload (no base64 overhead)."""
+    try:
+        chunks = []
+        size = 0
+        while chunk := await file.read(1024 * 1024):
+            size += len(chunk)
+            if size > DOCUMENT_MAX_BYTES:
+                raise HTTPException(status_code=413, detail="Document is too large.")
+            chunks.append(chunk)
+        return await analyze_image(b"".join(chunks), prompt, preferred_provider, use_fallback, user_id)
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Document analysis error: {e}")
         raise HTTPException(status_code=500, detail=f"Document analysis error: {str(e)}")
 
+# ===== Research fetcher =====
+# Pages are fetched through the shared async pool with a per-host concurrency
+# limit and a byte cap. The HTML is parsed incrementally while it streams in and
+# the download stops as soon as enough paragraph text has been collected.
+# Results are cached per URL and revalidated with ETag/Last-Modified. Every hop,
+# redirects included, must resolve to public addresses only, so the endpoints
+# cannot be used to reach internal services.
+
+RESEARCH_TEXT_LIMIT = 2000
+RESEARCH_MAX_BYTES = int(os.getenv("RESEARCH_MAX_BYTES", str(2 * 1024 * 1024)))
+RESEARCH_PER_HOST_LIMIT = int(os.getenv("RESEARCH_PER_HOST_LIMIT", "4"))
+RESEARCH_MAX_URLS = int(os.getenv("RESEARCH_MAX_URLS", "20"))
+RESEARCH_FRESH_SECONDS = float(os.getenv("RESEARCH_FRESH_SECONDS", "300"))
+RESEARCH_TIMEOUT = httpx.Timeout(15.0, connect=5.0)
+RESEARCH_MAX_REDIRECTS = 5
+RESEARCH_ALLOW_PRIVATE = os.getenv("RESEARCH_ALLOW_PRIVATE", "false").lower() == "true"  # local testing only
+
+research_cache = TTLCache(maxsize=int(os.getenv("RESEARCH_CACHE_SIZE", "1000")), ttl=float(os.getenv("RESEARCH_CACHE_TTL", "86400")))
+# host -> [semaphore, fetches holding or waiting on it]; dropped once idle
+_host_semaphores: Dict[str, list] = {}
+# Closing any of these ends the open paragraph, so unclosed <p> text is not lost.
+PARAGRAPH_END_TAGS = {"p", "div", "section", "article", "main", "li", "td", "blockquote", "body", "html"}
+
+class ParagraphExtractor(HTMLParser):
+    """Incremental <title>/<p> text extractor; `done` once `limit` characters are collected."""
+
+    def __init__(self, limit: int):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.title = ""
+        self.paragraphs: List[str] = []
+        self.length = 0
+        self._in_title = False
+        self._current: Optional[List[str]] = None
+
+    @property
+    def done(self) -> bool:
+        return self.length >= self.limit
+
+    def _close_paragraph(self):
+        text = " ".join(" ".join(self._current).split())
+        if text:
+            self.paragraphs.append(text)
+            self.length += len(text) + 1
+        self._current = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "p":
+            if self._current is not None:
+                self._close_paragraph()
+            self._current = []
+        elif tag == "title":
+            self._in_title = True
+
+    def handle_endtag(self, tag):
+        if tag in PARAGRAPH_END_TAGS and self._current is not None:
+            self._close_paragraph()
+        elif tag == "title":
+            self._in_title = False
+
+    def close(self):
+        super().close()
+        if self._current is not None:
+            self._close_paragraph()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        if self._current is not None:
+            self._current.append(data)
+
+@asynccontextmanager
+async def host_slot(url: str):
+    """Hold one of RESEARCH_PER_HOST_LIMIT concurrent fetch slots for the URL's host."""
+    host = urlsplit(url).hostname or ""
+    entry = _host_semaphores.get(host)
+    if entry is None:
+        entry = _host_semaphores[host] = [asyncio.Semaphore(RESEARCH_PER_HOST_LIMIT), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if not entry[1] and _host_semaphores.get(host) is entry:
+            del _host_semaphores[host]
+
+async def ensure_public_url(url: str):
+    """Reject URLs whose host resolves to a private, loopback, link-local or otherwise non-global address."""
+    host = urlsplit(url).hostname
+    if not host:
+        raise HTTPException(status_code=400, detail="URL has no host.")
+    if RESEARCH_ALLOW_PRIVATE:
+        return
+    try:
+        infos = await asyncio.get_running_loop().getaddrinfo(host, None)
+    except OSError:
+        raise HTTPException(status_code=400, detail=f"Could not resolve {host}.")
+    for *_, sockaddr in infos:
+        address = ipaddress.ip_address(sockaddr[0].split("%")[0])
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global:
+            raise HTTPException(status_code=400, detail="URL points to a private or local address.")
+
+async def fetch_page_summary(url: str) -> Dict[str, str]:
+    """Title and the first RESEARCH_TEXT_LIMIT characters of paragraph text for `url`."""
+    cached = research_cache.get(url)
+    if cached and time.monotonic() - cached["fetched_at"] < RESEARCH_FRESH_SECONDS:
+        return cached["result"]
+
+    headers = {"User-Agent": "Mozilla/5.0"}
+    if cached and cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+    if cached and cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+
+    async with host_slot(url):
+        target = url
+        for _ in range(RESEARCH_MAX_REDIRECTS + 1):
+            await ensure_public_url(target)
+            async with get_http_client().stream("GET", target, headers=headers, timeout=RESEARCH_TIMEOUT) as resp:
+                if resp.is_redirect and resp.next_request is not None:
+                    target = str(resp.next_request.url)
+                    continue
+                if resp.status_code == 304 and cached:
+                    cached["fetched_at"] = time.monotonic()
+                    research_cache.set(url, cached)
+                    return cached["result"]
+                resp.raise_for_status()
+                parser = ParagraphExtractor(RESEARCH_TEXT_LIMIT)
+                async for text in resp.aiter_text():
+                    parser.feed(text)
+                    if parser.done or resp.num_bytes_downloaded >= RESEARCH_MAX_BYTES:
+                        break
+                parser.close()
+                etag = resp.headers.get("ETag")
+                last_modified = resp.headers.get("Last-Modified")
+                break
+        else:
+            raise HTTPException(status_code=400, detail="Too many redirects.")
+
+    result = {"title": parser.title.strip(), "summary": " ".join(parser.paragraphs)[:RESEARCH_TEXT_LIMIT], "url": url}
+    research_cache.set(url, {"result": result, "etag": etag, "last_modified": last_modified, "fetched_at": time.monotonic()})
+    return result
+
+def is_http_url(value: str) -> bool:
+    return value.startswith("http://") or value.startswith("https://")
+
 @app.post("/api/research")
 async def research(request: ResearchRequest):
     """Conduct web research using Perplexity, Tavily, or basic scraping"""
     try:
         if request.source == "perplexity" and API_KEYS["perplexity"]:
+            cache_scope = "perplexity|llama-3-sonar-large-32k-online"
+            cached = vector = None
+            if research_response_cache.enabled:
+                cached, vector = await research_response_cache.lookup(request.query, cache_scope, get_embedding_client({}))
+                if cached is not None:
+                    return {"result": cached, "source": "perplexity", "cache": "hit"}
+
             headers = {
                 "Authorization": f"Bearer {API_KEYS['perplexity']}",
                 "Content-Type": "application/json"
@@ -369,9 +2817,15 @@ async def research(request: ResearchRequest):
                     {"role": "user", "content": request.query}
                 ]
             }
-            response = requests.post("https://api.perplexity.ai/chat/completions", headers=headers, json=payload)
+            with upstream_call("perplexity", "research"):
+                response = await get_http_client().post(
+                    "https://api.perplexity.ai/chat/completions", headers=headers, json=payload, timeout=httpx.Timeout(60.0, connect=5.0)
+                )
             response.raise_for_status()
-            return {"result": response.json()["choices"][0]["message"]["content"], "source": "perplexity"}
+            result = response.json()["choices"][0]["message"]["content"]
+            if research_response_cache.enabled:
+                research_response_cache.store(request.query, cache_scope, result, vector)
+            return {"result": result, "source": "perplexity", "cache": "miss" if research_response_cache.enabled else "bypass"}
         
         elif request.source == "tavily" and API_KEYS["tavily"]:
             # Tavily API call logic placeholder
@@ -379,25 +2833,107 @@ async def research(request: ResearchRequest):
 
         # Fallback: basic web scraping if the query is a URL
         url = request.query.strip()
-        if not (url.startswith("http://") or url.startswith("https://")):
+        if not is_http_url(url):
             return {
                 "result": "Provide a URL to scrape in 'query' or use source=perplexity/tavily.",
                 "source": "fallback"
             }
 
-        resp = requests.get(url, timeout=15, headers={"User-Agent": "Mozilla/5.0"})
-        resp.raise_for_status()
-        soup = BeautifulSoup(resp.text, "html.parser")
-
-        title = soup.title.string.strip() if soup.title and soup.title.string else ""
-        paragraphs = [p.get_text(" ", strip=True) for p in soup.find_all("p")]
-        text = " ".join(paragraphs)
-        summary = text[:2000]
-
-        return {"result": {"title": title, "summary": summary, "url": url}, "source": "scrape"}
+        return {"result": await fetch_page_summary(url), "source": "scrape"}
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Research error: {e}")
         raise HTTPException(status_code=500, detail=f"Research error: {str(e)}")
+
+@app.post("/api/research/urls")
+async def research_urls(request: ResearchURLsRequest, user_id: str = Depends(get_current_user)):
+    """Scrape several URLs concurrently. Results are streamed back as NDJSON, one line
+    per URL in completion order: {"url", "result"} or {"url", "error"}."""
+    urls = [u.strip() for u in request.urls if u.strip()][:RESEARCH_MAX_URLS]
+
+    async def fetch(url: str):
+        if not is_http_url(url):
+            return {"url": url, "error": "Not an http(s) URL"}
+        try:
+            return {"url": url, "result": await fetch_page_summary(url)}
+        except HTTPException as e:
+            return {"url": url, "error": e.detail}
+        except Exception as e:
+            print(f"Research error: {e}")
+            return {"url": url, "error": str(e)}
+
+    async def lines():
+        tasks = [asyncio.create_task(fetch(url)) for url in urls]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield json.dumps(await finished) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+# ===== Settings endpoints =====
+
+def mask_key(value: str) -> str:
+    if not value:
+        return ""
+    if len(value) <= 8:
+        return "***"
+    return f"{value[:4]}***{value[-4:]}"
+
+async def ensure_settings_indexes():
+    await db.settings.create_index([("user_id", 1)], unique=True)
+    await db.settings.create_index([("version", 1)])
+    # One settings_version counter: with two, versions from the lower one fall behind the sync poller.
+    await db.meta.create_index("key", unique=True)
+    try:
+        await db.meta.update_one({"key": "settings_version"}, {"$setOnInsert": {"value": 0}}, upsert=True)
+    except DuplicateKeyError:
+        pass  # seeded concurrently by another worker
+
+def start_settings_sync():
+    global _settings_sync_task
+    _settings_sync_task = run_in_background(sync_settings_cache())
+
+def stop_settings_sync():
+    if _settings_sync_task is not None:
+        _settings_sync_task.cancel()
+
+_settings_sync_task: Optional[asyncio.Task] = None
+
+@app.get("/api/settings/keys")
+async def get_api_keys(user_id: str = Depends(get_current_user)):
+    """Return the user's stored API keys, masked."""
+    user_settings = await db.settings.find_one({"user_id": user_id}) or {}
+    api_keys = user_settings.get("api_keys") or {}
+    custom_keys = user_settings.get("custom_keys") or {}
+    return {
+        "keys": {name: mask_key(value) for name, value in api_keys.items()},
+        "custom_keys": {name: mask_key(value) for name, value in custom_keys.items()},
+    }
+
+@app.post("/api/settings/keys")
+async def update_api_keys(request: APIKeysUpdate, user_id: str = Depends(get_current_user)):
+    """Store API keys for the user. Only fields that are present are overwritten."""
+    updates = request.model_dump(exclude_none=True)
+    custom_keys = updates.pop("custom_keys", None) or {}
+
+    meta = await db.meta.find_one_and_update(
+        {"key": "settings_version"},
+        {"$inc": {"value": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    fields = {f"api_keys.{name}": value for name, value in updates.items()}
+    fields.update({f"custom_keys.{name}": value for name, value in custom_keys.items()})
+    fields.update({"version": meta["value"], "updated_at": datetime.now()})
+    await db.settings.update_one({"user_id": user_id}, {"$set": fields}, upsert=True)
+
+    settings_cache.pop(user_id)
+    return {"ok": True}
+
 # ===== AI Name endpoints (public) =====
 
 class ChooseNameRequest(BaseModel):
@@ -463,6 +2999,18 @@ async def choose_ai_name(req: ChooseNameRequest):
         return {"ok": True, "name": name, "source": "fallback"}
 
     try:
+        cache_scope = f"name|{model_for_provider('openai', use_fallback=False)}"
+        cached = vector = None
+        if name_cache.enabled:
+            cached, vector = await name_cache.lookup(persona, cache_scope, get_embedding_client({}))
+        if cached is not None:
+            await db.meta.update_one(
+                {"key": "ai_name"},
+                {"$set": {"value": cached, "updated_at": datetime.now()}},
+                upsert=True,
+            )
+            return {"ok": True, "name": cached, "source": "llm", "cache": "hit"}
+
         client = get_openai_client(use_fallback=False)
         system_prompt = (
             "You are a luxury brand identity expert. Choose a SINGLE refined, "
@@ -475,7 +3023,7 @@ async def choose_ai_name(req: ChooseNameRequest):
             "- Output ONLY the name with no quotes or punctuation."
         )
         user_msg = f"Branding context:\n{persona}\nProvide only the name."
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model=model_for_provider("openai", use_fallback=False),
             messages=[
                 {"role": "system", "content": system_prompt},
@@ -491,13 +3039,15 @@ async def choose_ai_name(req: ChooseNameRequest):
         name = cleaned.splitlines()[0].strip()
         if not name:
             name = "Valentina"
+        elif name_cache.enabled:
+            name_cache.store(persona, cache_scope, name, vector)
 
         await db.meta.update_one(
             {"key": "ai_name"},
             {"$set": {"value": name, "updated_at": datetime.now()}},
             upsert=True,
         )
-        return {"ok": True, "name": name, "source": "llm"}
+        return {"ok": True, "name": name, "source": "llm", "cache": "miss" if name_cache.enabled else "bypass"}
     except Exception as e:
         print(f"choose_ai_name error: {e}")
         # Fallback on error
@@ -5,7 +5,8 @@ import './HistoryScreen.css';
 
 interface Conversation {
   _id: string;
-  messages: Array<{ role: string; content: string }>;
+  title?: string;
+  snippet?: string;
   created_at: string;
   updated_at: string;
 }
@@ -43,9 +44,7 @@ const HistoryScreen: React.FC = () => {
   };
 
   const getConversationPreview = (conv: Conversation) => {
-    const userMessages = conv.messages.filter(m => m.role === 'user');
-    if (userMessages.length === 0) return 'New conversation';
-    return userMessages[0].content.slice(0, 100) + (userMessages[0].content.length > 100 ? '...' : '');
+    return conv.title || conv.snippet || 'New conversation';
   };
 
   return (